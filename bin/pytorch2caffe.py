@@ -13,6 +13,8 @@ sys.path.append(os.path.dirname(os.path.abspath(__file__)) + '/../')
 import caffe  # noqa
 from converter.pytorch.pytorch_caffe_parser import PytorchCaffeParser  # noqa
 
+_TRAILING_INT = re.compile(r'(\d+)(?!.*\d)')
+
 class Runner(object):
     def __init__(self, name, model, shape, opset_version, fuse=False):
         self.name = name
@@ -20,27 +22,56 @@ class Runner(object):
         self.shape = shape
         self.opset_version = opset_version
         self.fuse = fuse
+        self.model_file = os.path.join("tmp", name)
+        self.prototxt_path = self.model_file + ".prototxt"
+        self.caffemodel_path = self.model_file + ".caffemodel"
+        self.dummy_shape = None
+        self.dummy_input = None
+        self.dummy_input_np = None
+        self.traced = None
+        self.prepared = False
 
     def pyotrch_inference(self, generate_onnx=False):
-        self.model_file = "tmp/" + self.name
-        self.device = torch.device('cpu')
-        self.model = self.model.eval().to(self.device)
+        if not self.prepared:
+            self.device = torch.device('cpu')
+            self.model = self.model.eval().to(self.device)
+            self.prepared = True
 
-        if isinstance(self.shape, tuple):
+        if self.dummy_shape != self.shape:
+            shapes = self.shape if isinstance(self.shape, tuple) else (self.shape,)
             self.dummy_input = []
-            for each in self.shape:
+            for each in shapes:
                 dummy = torch.rand(each).to(torch.float32)
+                if dummy.ndim == 4:
+                    dummy = dummy.to(memory_format=torch.channels_last)
                 self.dummy_input.append(dummy)
-        else:
-            self.dummy_input = [torch.rand(self.shape).to(torch.float32)]
+            # caffe blobs are plain NCHW, so channels_last inputs are repacked here
+            self.dummy_input_np = [np.ascontiguousarray(dummy.numpy()) for dummy in self.dummy_input]
+            self.dummy_shape = self.shape
+            self.traced = None
+
+            if any(dummy.ndim == 4 for dummy in self.dummy_input):
+                self.model = self.model.to(memory_format=torch.channels_last)
 
-        self.pytorch_output  = self.model(*self.dummy_input)
+        if self.traced is None:
+            try:
+                with torch.no_grad():
+                    self.traced = torch.jit.trace(self.model, tuple(self.dummy_input), check_trace=False)
+            except Exception as e:
+                logger.warning("torch.jit.trace failed, running model eagerly: %s" % e)
+                self.traced = self.model
+
+        with torch.inference_mode():
+            self.pytorch_output = self.traced(*self.dummy_input)
 
         if isinstance(self.pytorch_output , torch.Tensor):
             self.pytorch_output = [self.pytorch_output]        
  
         if generate_onnx:
-            torch.onnx.export(self.model, tuple(self.dummy_input), self.name + ".onnx", opset_version=self.opset_version, enable_onnx_checker=False)
+            if hasattr(torch.onnx, 'dynamo_export'):
+                torch.onnx.dynamo_export(self.model, *self.dummy_input).save(self.name + ".onnx")
+            else:
+                torch.onnx.export(self.model, tuple(self.dummy_input), self.name + ".onnx", opset_version=self.opset_version, enable_onnx_checker=False)
         
     def convert(self, export_mode=False):
         self.model.export_mode = export_mode
@@ -48,18 +79,15 @@ class Runner(object):
         pytorch_parser.run(self.model_file)
 
     def caffe_inference(self):
-        prototxt = "tmp/" + self.name + '.prototxt'
-        caffemodel = "tmp/" + self.name + '.caffemodel'
-
-        self.net = caffe.Net(prototxt, caffe.TEST, weights=caffemodel)
+        self.net = caffe.Net(self.prototxt_path, caffe.TEST, weights=self.caffemodel_path)
 
         if isinstance(self.shape, tuple):
             for idx, _ in enumerate(self.shape):
-                img = self.dummy_input[idx].numpy()
-                self.net.blobs['data_' + str(idx)].data[...] = img
+                img = self.dummy_input_np[idx]
+                np.copyto(self.net.blobs['data_' + str(idx)].data, img, casting='no')
         else:
-            img = self.dummy_input[0].numpy()
-            self.net.blobs['data'].data[...] = img
+            img = self.dummy_input_np[0]
+            np.copyto(self.net.blobs['data'].data, img, casting='no')
 
         self.caffe_output = self.net.forward()
 
@@ -67,13 +95,17 @@ class Runner(object):
         assert len(self.pytorch_output) == len(self.caffe_output), "pytorch_output: %d vs caffe_output %d" % (len(self.pytorch_output), len(self.caffe_output))
 
         caffe_outname = self.net.outputs
-        caffe_outname = sorted(caffe_outname, key=lambda x: re.findall(r'\d+', x)[-1])
-
-        for idx in range(len(self.caffe_output)):
-            np.testing.assert_allclose(
-                self.caffe_output[caffe_outname[idx]],
-                self.pytorch_output[idx].detach().numpy(),
-                rtol=1e-7,
-                atol=1e-5,
-            )
+        caffe_outname = sorted(caffe_outname, key=lambda x: int(_TRAILING_INT.search(x).group(1)))
+
+        caffe_output = [torch.from_numpy(self.caffe_output[name]) for name in caffe_outname]
+        for caffe_out, pytorch_out in zip(caffe_output, self.pytorch_output):
+            assert caffe_out.shape == pytorch_out.shape, "caffe_output shape %s vs pytorch_output shape %s" % (tuple(caffe_out.shape), tuple(pytorch_out.shape))
+
+        torch.testing.assert_close(
+            torch.cat([output.reshape(-1) for output in caffe_output]),
+            torch.cat([output.reshape(-1) for output in self.pytorch_output]),
+            rtol=1e-7,
+            atol=1e-5,
+            check_dtype=False,
+        )
         print("accuracy test passed")
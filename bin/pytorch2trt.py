@@ -27,15 +27,17 @@ class HostDeviceMem(object):
         return self.__str__()
 
 class Runner(object):
-    def __init__(self, name, model, shape, opset_version):
+    def __init__(self, name, model, shape, opset_version, use_onnx_parser=False):
         self.name = name
+        self.use_onnx_parser = use_onnx_parser
         self.model = model
         self.shape = shape
         self.opset_version = opset_version
         self.fuse = True
+        self.model_file = os.path.join("tmp", name)
+        self.engine_path = self.model_file + ".trt"
 
     def pyotrch_inference(self, generate_onnx=False):
-        self.model_file = "tmp/" + self.name
         self.device = torch.device('cpu')
         self.model = self.model.eval().to(self.device)
         if isinstance(self.shape, tuple):
@@ -45,6 +47,7 @@ class Runner(object):
                 self.dummy_input.append(dummy)
         else:
             self.dummy_input = [torch.rand(self.shape).to(torch.float32)]
+        self.dummy_input_np = [np.ascontiguousarray(dummy.numpy()) for dummy in self.dummy_input]
 
         self.pytorch_output  = self.model(*self.dummy_input)
 
@@ -56,37 +59,34 @@ class Runner(object):
         
     def convert(self, export_mode=False):
         self.model.export_mode = export_mode
-        pytorch_parser = PytorchTensorRTParser(self.model, self.shape, self.opset_version, self.fuse)
-        pytorch_parser.run(self.model_file)
+        self.pytorch_parser = PytorchTensorRTParser(self.model, self.shape, self.opset_version, self.fuse, use_onnx_parser=self.use_onnx_parser)
+        self.pytorch_parser.run(self.model_file)
+
+    def graph_inference(self):
+        runner = self.pytorch_parser.build_runner()
+        self.trt_output = runner.infer(*self.dummy_input_np)
 
     def trt_inference(self):
-        engine_file = "tmp/" + self.name + '.trt'
         self.logger = trt.Logger(trt.Logger.WARNING)
 
-        if isinstance(self.shape, tuple):
-            dummy_input = []
-            for idx, _ in enumerate(self.shape):
-                dummy_input.append(self.dummy_input[idx].numpy())
-        else:
-            dummy_input = self.dummy_input[0].numpy()
-
         with trt.Runtime(self.logger) as trt_runtime:
             trt.init_libnvinfer_plugins(None, "")             
-            with open(engine_file, 'rb') as f:
+            with open(self.engine_path, 'rb') as f:
                 engine_data = f.read()
             engine = trt_runtime.deserialize_cuda_engine(engine_data)
             inputs, outputs, bindings, stream = self.allocate_buffers(engine)
 
             with engine.create_execution_context() as context:
-                if len(inputs) == 1:
-                    np.copyto(inputs[0].host, dummy_input.ravel())
-                else:   
-                    for idx in range(len(inputs)):
-                        np.copyto(inputs[idx].host, dummy_input[idx].ravel())        
+                for inp, dummy in zip(inputs, self.dummy_input_np):
+                    np.copyto(inp.host, dummy.ravel())
 
                 for inp in inputs:
                     cuda.memcpy_htod_async(inp.device, inp.host, stream)
-                context.execute_async(batch_size=1, bindings=bindings, stream_handle=stream.handle)
+                if engine.has_implicit_batch_dimension:
+                    context.execute_async(batch_size=1, bindings=bindings, stream_handle=stream.handle)
+                else:
+                    # engines built through the onnx parser are explicit batch
+                    context.execute_async_v2(bindings=bindings, stream_handle=stream.handle)
                 for out in outputs:
                     cuda.memcpy_dtoh_async(out.host, out.device, stream) 
                     
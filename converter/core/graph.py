@@ -78,11 +78,12 @@ class Graph(object):
 
     def get_son(self, name, path, set_flag = False):
         if name == None: return None
-        current_node = self.get_node(name)
+        get_node = self.get_node
+        current_node = get_node(name)
         for idx in path:
             if len(current_node.out_edges) <= idx: return None
             son_name = current_node.out_edges[idx].split(':')[0]
-            current_node = self.get_node(son_name)
+            current_node = get_node(son_name)
             if set_flag:
                 current_node.covered = True
         return current_node
@@ -90,22 +91,24 @@ class Graph(object):
 
     def get_parent(self, name, path, set_flag = False):
         if name == None: return None
-        current_node = self.get_node(name)
+        get_node = self.get_node
+        current_node = get_node(name)
         for idx in path:
             if len(current_node.in_edges) <= idx: return None
             parent_name = current_node.in_edges[idx].split(':')[0]
-            current_node = self.get_node(parent_name)
+            current_node = get_node(parent_name)
             if set_flag:
                 current_node.covered = True
         return current_node
 
     def get_real_parent_name(self, name, path, set_flag = False):
         if name == None: return None
-        current_node = self.get_node(name)
+        get_node = self.get_node
+        current_node = get_node(name)
         for idx in path:
             if len(current_node.in_edges) <= idx: return None
             parent_name = current_node.in_edges[idx].split(':')[0]
-            current_node = self.get_node(parent_name)
+            current_node = get_node(parent_name)
             if set_flag:
                 current_node.covered = True
         return self.layer_name_map[current_node.name]
@@ -113,12 +116,13 @@ class Graph(object):
 
     def get_parent_variable_name(self, name, path, set_flag = False):
         if name == None: return None
-        current_node = self.get_node(name)
+        get_node = self.get_node
+        current_node = get_node(name)
         for idx in path:
             if len(current_node.in_edges) <= idx: return None
             parent_name = current_node.in_edges[idx].split(':')[0]
             current_subscriptor = '' if len(current_node.in_edges[idx].split(':'))==1 else '[{}]'.format(current_node.in_edges[idx].split(':')[1])
-            current_node = self.get_node(parent_name)
+            current_node = get_node(parent_name)
             if set_flag:
                 current_node.covered = True
 
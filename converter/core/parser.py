@@ -5,6 +5,9 @@
 
 import numpy as np
 
+# channel-first axis -> IR (channel-last) axis, indexed by the source axis
+_AXIS_LUT = (0, -1) + tuple(range(1, 64))
+
 class Parser(object):
 
     def __init__(self):
@@ -22,31 +25,25 @@ class Parser(object):
         return self.src_graph.get_parent(name, path, set_flag)
 
     def set_weight(self, layer_name, weight_name, data):
-        if not layer_name in self.weights:
-            self.weights[layer_name] = dict()
-        layer = self.weights[layer_name]
-        layer[weight_name] = data
+        self.weights[(layer_name, weight_name)] = data
 
     def convert_inedge(self, source_node, IR_node, start_idx = 0, end_idx = None):
         if end_idx == None: end_idx = len(source_node.in_edges)
-        for idx in range(start_idx, end_idx):
-            IR_node.input.append(self.src_graph.get_node(source_node.in_edges[idx]).real_name.lstrip('_'))
+        graph = self.src_graph
+        names = [graph.get_node(source_node.in_edges[idx]).real_name.lstrip('_') for idx in range(start_idx, end_idx)]
+        IR_node.input.extend(names)
 
     @staticmethod
     def channel_first_conv_kernel_to_IR(tensor):
-        dim = tensor.ndim
-        tensor = np.transpose(tensor, list(range(2, dim)) + [1, 0])
-        return tensor
+        perm = list(range(2, tensor.ndim)) + [1, 0]
+        return np.transpose(tensor, perm).copy(order='C')
 
     @staticmethod
     def channel_first_shape_to_IR(shape):
-        return [shape[0]] + list(shape[2:]) + [shape[1]]
+        return (shape[0], *shape[2:], shape[1])
 
     @staticmethod
     def channel_first_axis_to_IR(index):
-        if index == 0:
-            return 0
-        elif index == 1:
-            return -1
-        else:
-            return index - 1
+        if 0 <= index < len(_AXIS_LUT):
+            return _AXIS_LUT[index]
+        return index - 1
@@ -2,6 +2,8 @@
 #  Copyright (c) Microsoft Corporation. All rights reserved.
 #  Licensed under the MIT License. See License.txt in the project root for license information.
 #----------------------------------------------------------------------------------------------
+import types
+
 import numpy as np
 from loguru import logger
 from converter.core.parser import Parser
@@ -13,7 +15,9 @@ from torch.nn.utils.fusion import fuse_conv_bn_eval, fuse_linear_bn_eval
 
 import google.protobuf.text_format
 
-layer_map = {
+# handler registry, onnx type -> rename_<value>. resolved once per parser into self._dispatch,
+# onnx types missing from this map raise KeyError, mapped types without a rename_ method use rename_Common
+layer_map = types.MappingProxyType({
     'Data': 'Data',
     'onnx::Conv': 'Conv',
     'onnx::Sigmoid': 'Sigmoid',
@@ -56,7 +60,7 @@ layer_map = {
     'onnx::Cast': 'Common',
     'onnx::ConstantOfShape': 'Common',
     'onnx::Div': 'Common',
-}
+})
 
 def as_blob(array):
     blob = pb2.BlobProto()
@@ -80,6 +84,8 @@ class PytorchCaffeParser(Parser):
         self.named_layer = dict()
         self.named_node = dict()
         self.main_layers = []
+        self._main_tops = set()
+        self._dispatch = {k: getattr(self, "rename_" + v, self.rename_Common) for k, v in layer_map.items()}
 
     def run(self, dest_path):
         text_net, binary_weights = self.gen_IR()
@@ -120,38 +126,27 @@ class PytorchCaffeParser(Parser):
             else:
                 stack.append((name, module))
 
-    def is_main(self, inputs):
-        for input in inputs:
-            find = False
-            for layer in self.main_layers:
-                if input in layer.top:
-                    find = True
-                    break
-
-            if find == False:
-                return False
+    def _append_main(self, caffe_layer):
+        self.main_layers.append(caffe_layer)
+        self._main_tops.update(caffe_layer.top)
 
-        return True
+    def is_main(self, inputs):
+        return all(input in self._main_tops for input in inputs)
 
     def gen_IR(self):
-        for node in self.src_graph.topological_sort:
-            current_node = self.src_graph.get_node(node)
-            self.named_node[current_node.real_name] = current_node
-            onnx_node_type = current_node.type
-            node_type = layer_map[onnx_node_type]
-
-            if hasattr(self, "rename_" + node_type):
-                func = getattr(self, "rename_" + node_type)
-                layer_data = func(current_node)
-                if layer_data == None:
-                    continue
-                elif(isinstance(layer_data, tuple)):
-                    self.named_layer[layer_data[0].name] = layer_data[0]
-                    self.named_layer[layer_data[1].name] = layer_data[1] # some batchnorm will not be eliminated
-                else:                 
-                    self.named_layer[layer_data.name] = layer_data
-            else:
-                self.rename_Common(current_node)
+        graph = self.src_graph
+        nodes = [graph.get_node(node) for node in graph.topological_sort]
+        self.named_node = {current_node.real_name: current_node for current_node in nodes}
+        for current_node in nodes:
+            # unmapped onnx types raise KeyError, mapped types without a handler fall back to rename_Common
+            layer_data = self._dispatch[current_node.type](current_node)
+            if layer_data == None:
+                continue
+            elif(isinstance(layer_data, tuple)):
+                self.named_layer[layer_data[0].name] = layer_data[0]
+                self.named_layer[layer_data[1].name] = layer_data[1] # some batchnorm will not be eliminated
+            else:                 
+                self.named_layer[layer_data.name] = layer_data
 
         text_net = pb2.NetParameter()
         binary_weights = pb2.NetParameter()
@@ -190,7 +185,7 @@ class PytorchCaffeParser(Parser):
         layer.input_param.shape.extend([input_shape])
         layer.top.append(source_node.name)
         layer.name = source_node.name
-        self.main_layers.append(layer)
+        self._append_main(layer)
         self.named_layer[source_node.name] = layer
         return layer
 
@@ -270,7 +265,7 @@ class PytorchCaffeParser(Parser):
         layer.name = source_node.real_name
 
         if self.is_main(layer.bottom):
-            self.main_layers.append(layer)
+            self._append_main(layer)
         return layer
 
     def rename_PRelu(self, source_node):
@@ -296,7 +291,7 @@ class PytorchCaffeParser(Parser):
 
         layer.name = source_node.real_name
         if self.is_main(layer.bottom):
-            self.main_layers.append(layer)
+            self._append_main(layer)
         return layer
 
     def rename_GlobalAveragePool(self, source_node):
@@ -311,7 +306,7 @@ class PytorchCaffeParser(Parser):
         layer.top.append(source_node.name)
         layer.name = source_node.real_name
         if self.is_main(layer.bottom):
-            self.main_layers.append(layer)
+            self._append_main(layer)
         return layer
 
     def rename_Sigmoid(self, source_node):
@@ -324,7 +319,7 @@ class PytorchCaffeParser(Parser):
         layer.top.append(source_node.name)
         layer.name = source_node.real_name
         if self.is_main(layer.bottom):
-            self.main_layers.append(layer)
+            self._append_main(layer)
         return layer
 
     def rename_BatchNormalization(self, source_node):
@@ -379,8 +374,8 @@ class PytorchCaffeParser(Parser):
 
         layer_scale.name = source_node.real_name
         if self.is_main(layer_bn.bottom):
-            self.main_layers.append(layer_bn)
-            self.main_layers.append(layer_scale)
+            self._append_main(layer_bn)
+            self._append_main(layer_scale)
         return layer_bn, layer_scale
 
     def rename_Relu(self, source_node):
@@ -393,7 +388,7 @@ class PytorchCaffeParser(Parser):
         layer.top.append(source_node.name)
         layer.name = source_node.real_name
         if self.is_main(layer.bottom):
-            self.main_layers.append(layer)
+            self._append_main(layer)
         return layer
 
     def rename_MaxPool(self, source_node):
@@ -452,7 +447,7 @@ class PytorchCaffeParser(Parser):
 
         layer.name = source_node.real_name
         if self.is_main(layer.bottom):
-            self.main_layers.append(layer)
+            self._append_main(layer)
         return layer
 
     def rename_Add(self, source_node):
@@ -465,7 +460,7 @@ class PytorchCaffeParser(Parser):
         layer.top.append(source_node.name)
         layer.name = source_node.real_name
         if self.is_main(layer.bottom):
-            self.main_layers.append(layer)
+            self._append_main(layer)
         return layer
 
     def rename_AveragePool(self, source_node):
@@ -520,7 +515,7 @@ class PytorchCaffeParser(Parser):
         layer.top.append(source_node.name)
         layer.name = source_node.real_name
         if self.is_main(layer.bottom):
-            self.main_layers.append(layer)
+            self._append_main(layer)
         return layer
 
     def rename_Flatten(self, source_node):
@@ -533,7 +528,7 @@ class PytorchCaffeParser(Parser):
         layer.top.append(source_node.name)
         layer.name = source_node.real_name
         if self.is_main(layer.bottom):
-            self.main_layers.append(layer)
+            self._append_main(layer)
         return layer
 
     def rename_FullyConnected(self, source_node):
@@ -572,7 +567,7 @@ class PytorchCaffeParser(Parser):
         layer.top.append(source_node.name)
         layer.name = source_node.real_name
         if self.is_main(layer.bottom):
-            self.main_layers.append(layer)
+            self._append_main(layer)
         return layer
 
     def rename_Dropout(self, source_node):
@@ -603,7 +598,7 @@ class PytorchCaffeParser(Parser):
         layer.top.append(source_node.name)
         layer.name = source_node.real_name
         if self.is_main(layer.bottom):
-            self.main_layers.append(layer)
+            self._append_main(layer)
         return layer
 
     def rename_Permute(self, source_node):
@@ -622,7 +617,7 @@ class PytorchCaffeParser(Parser):
 
         layer.name = source_node.real_name
         if self.is_main(layer.bottom):
-            self.main_layers.append(layer)
+            self._append_main(layer)
         return layer
 
     def rename_Upsample(self, source_node):
@@ -640,7 +635,7 @@ class PytorchCaffeParser(Parser):
 
         layer.name = source_node.real_name
         if self.is_main(layer.bottom):
-            self.main_layers.append(layer)        
+            self._append_main(layer)        
         return layer
 
     def rename_Concat(self, source_node):
@@ -657,7 +652,7 @@ class PytorchCaffeParser(Parser):
 
         layer.name = source_node.real_name
         if self.is_main(layer.bottom):
-            self.main_layers.append(layer)   
+            self._append_main(layer)   
 
         return layer
 
@@ -678,7 +673,7 @@ class PytorchCaffeParser(Parser):
 
         layer.name = source_node.real_name
         if self.is_main(layer.bottom):
-            self.main_layers.append(layer)        
+            self._append_main(layer)        
         return layer
 
     def rename_Relu6(self, source_node):
@@ -695,7 +690,7 @@ class PytorchCaffeParser(Parser):
 
         layer.name = source_node.real_name
         if self.is_main(layer.bottom):
-            self.main_layers.append(layer)        
+            self._append_main(layer)        
         return layer     
 
     def rename_Pad(self, source_node):
@@ -722,7 +717,7 @@ class PytorchCaffeParser(Parser):
         layer.name = source_node.real_name
 
         if self.is_main(layer.bottom):
-            self.main_layers.append(layer)
+            self._append_main(layer)
 
         return layer   
 
@@ -738,7 +733,7 @@ class PytorchCaffeParser(Parser):
         layer.name = source_node.real_name
 
         if self.is_main(layer.bottom):
-            self.main_layers.append(layer)
+            self._append_main(layer)
 
         return layer      
 
@@ -759,7 +754,7 @@ class PytorchCaffeParser(Parser):
 
         layer.name = source_node.real_name
         if self.is_main(layer.bottom):
-            self.main_layers.append(layer)
+            self._append_main(layer)
 
         return layer            
 
@@ -773,7 +768,7 @@ class PytorchCaffeParser(Parser):
             layer.top.append(source_node.name)
             layer.name = source_node.real_name     
             if self.is_main(layer.bottom):
-                self.main_layers.append(layer)
+                self._append_main(layer)
             return layer     
         elif self.named_node[source_node.in_edges[0]].output_shape[-2:] == self.named_node[source_node.in_edges[1]].output_shape[-2:]:
             layer = pb2.LayerParameter()
@@ -784,7 +779,7 @@ class PytorchCaffeParser(Parser):
             layer.top.append(source_node.name)
             layer.name = source_node.real_name
             if self.is_main(layer.bottom):
-                self.main_layers.append(layer)    
+                self._append_main(layer)    
             return layer
 
         elif self.named_node[source_node.in_edges[0]].output_shape[-2:] == [1, 1]:
@@ -804,8 +799,8 @@ class PytorchCaffeParser(Parser):
             layer_scale.name = source_node.real_name
 
             if self.is_main(source_node.in_edges):
-                self.main_layers.append(layer_flatten)
-                self.main_layers.append(layer_scale)
+                self._append_main(layer_flatten)
+                self._append_main(layer_scale)
             return layer_flatten, layer_scale
 
         elif self.named_node[source_node.in_edges[1]].output_shape[-2:] == [1, 1]:
@@ -824,8 +819,8 @@ class PytorchCaffeParser(Parser):
             layer_scale.name = source_node.real_name
 
             if self.is_main(source_node.in_edges):
-                self.main_layers.append(layer_flatten)
-                self.main_layers.append(layer_scale)
+                self._append_main(layer_flatten)
+                self._append_main(layer_scale)
             return layer_flatten, layer_scale      
         else:
             layer = pb2.LayerParameter()
@@ -836,7 +831,7 @@ class PytorchCaffeParser(Parser):
             layer.top.append(source_node.name)
             layer.name = source_node.real_name     
             if self.is_main(layer.bottom):
-                self.main_layers.append(layer)
+                self._append_main(layer)
             return layer                
 
     def rename_Slice(self, source_node):
@@ -848,7 +843,7 @@ class PytorchCaffeParser(Parser):
         layer.top.append(source_node.name)
         layer.name = source_node.real_name
         if self.is_main(layer.bottom):
-            self.main_layers.append(layer)
+            self._append_main(layer)
         return layer        
 
     def rename_Reshape(self, source_node):
@@ -872,7 +867,7 @@ class PytorchCaffeParser(Parser):
         layer.name = source_node.real_name
 
         if self.is_main(layer.bottom):
-            self.main_layers.append(layer)        
+            self._append_main(layer)        
 
         return layer        
 
@@ -896,7 +891,7 @@ class PytorchCaffeParser(Parser):
 
         layer.name = source_node.real_name
         if self.is_main(layer.bottom):
-            self.main_layers.append(layer)        
+            self._append_main(layer)        
         return layer                          
 
     def rename_LpNormalization(self, source_node):
@@ -920,7 +915,7 @@ class PytorchCaffeParser(Parser):
 
         layer.name = source_node.real_name
         if self.is_main(layer.bottom):
-            self.main_layers.append(layer)
+            self._append_main(layer)
         return layer             
 
     def rename_Resize(self, source_node):
@@ -938,7 +933,7 @@ class PytorchCaffeParser(Parser):
             layer.top.append(source_node.name)
             layer.name = source_node.real_name
             if self.is_main(layer.bottom):
-                self.main_layers.append(layer)        
+                self._append_main(layer)        
             return layer
 
         elif attr['mode'] == "linear":
@@ -962,7 +957,7 @@ class PytorchCaffeParser(Parser):
             layer.top.append(source_node.name)
             layer.name = source_node.real_name
             if self.is_main(layer.bottom):
-                self.main_layers.append(layer)
+                self._append_main(layer)
             return layer
         else:         
             raise Exception('Unsupported mode: {}'.format(attr['mode']))
@@ -980,7 +975,7 @@ class PytorchCaffeParser(Parser):
         layer.top.append(source_node.name)
         layer.name = source_node.real_name
         if self.is_main(layer.bottom):
-            self.main_layers.append(layer)
+            self._append_main(layer)
         return layer
 
     def rename_ReduceMean(self, source_node):
@@ -995,7 +990,7 @@ class PytorchCaffeParser(Parser):
         layer.top.append(source_node.name)
         layer.name = source_node.real_name
         if self.is_main(layer.bottom):
-            self.main_layers.append(layer)
+            self._append_main(layer)
         return layer      
 
     def rename_BilinearInterpolate(self, source_node):
@@ -1017,7 +1012,7 @@ class PytorchCaffeParser(Parser):
             layer.top.append(source_node.name)
             layer.name = source_node.real_name
             if self.is_main(layer.bottom):
-                self.main_layers.append(layer)
+                self._append_main(layer)
             return layer  
         else:
             raise Exception('Unsupported opset_version: {}'.format(self.opset_version))
@@ -1036,7 +1031,7 @@ class PytorchCaffeParser(Parser):
         layer.name = source_node.real_name
 
         if self.is_main(layer.bottom):
-            self.main_layers.append(layer) 
+            self._append_main(layer) 
               
         return layer  
      
@@ -1115,5 +1110,5 @@ class PytorchCaffeParser(Parser):
 
         layer.name = source_node.real_name
         if self.is_main(layer.bottom):
-            self.main_layers.append(layer)
+            self._append_main(layer)
         return layer     
\ No newline at end of file
@@ -2,20 +2,42 @@
 #  Copyright (c) Microsoft Corporation. All rights reserved.
 #  Licensed under the MIT License. See License.txt in the project root for license information.
 #----------------------------------------------------------------------------------------------
+"""Convert a traced PyTorch graph into a TensorRT network.
+
+The hot path is the topological walk in ``gen_IR`` with one ``rename_*`` call per node.
+That loop is bound by Python dispatch and memory traffic, not by arithmetic. Tuning it
+means fewer lookups per node: the dispatch table, the ``_main_tops`` set behind
+``is_main``, weights converted once in ``_weights_np``, and batched protobuf writes.
+Vectorizing it will not help.
+"""
+import io
+import os
+import types
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 from loguru import logger
 from converter.core.parser import Parser
 from converter.pytorch.pytorch_graph import PytorchGraph
 import caffe.proto.caffe_pb2 as pb2
 
+import torch.fx
 import torch.nn as nn
 from torch.nn.utils.fusion import fuse_conv_bn_eval, fuse_linear_bn_eval
 
 import google.protobuf.text_format
 import tensorrt as trt
 
+try:
+    import pycuda.driver as cuda
+except ImportError:
+    cuda = None
+
 
-layer_map = {
+# handler registry, onnx type -> rename_<value>. resolved once per parser into self._dispatch,
+# types without a rename_ method fall back to rename_Common
+layer_map = types.MappingProxyType({
     'Data': 'Data',
     'onnx::Conv': 'Conv',
     'onnx::Sigmoid': 'Sigmoid',
@@ -59,28 +81,251 @@ layer_map = {
     'onnx::ConstantOfShape': 'Common',
     'onnx::Div': 'Common',
     'onnx::ArgMax': 'ArgMax'
-}
+})
+
+def _conv_attrs(attr):
+    # onnx pads are [h_begin, w_begin, h_end, w_end], a 2 element list pads both sides alike
+    pads = attr.get('pads', (0, 0))
+    pre_padding = tuple(pads[0:2])
+    post_padding = tuple(pads[2:4]) or pre_padding
+    strides = tuple(attr.get('strides', (1, 1))[0:2])
+    kernel_shape = tuple(attr.get('kernel_shape', (1, 1))[0:2])
+    return pre_padding, post_padding, strides, kernel_shape
+
+class _NumpyWeights(dict):
+    # state_dict as contiguous float32 arrays, each tensor converted once on first use.
+    # float32 cpu tensors come back as views sharing the torch storage, not copies.
+    def __init__(self, state_dict):
+        super(_NumpyWeights, self).__init__()
+        self.state_dict = state_dict
+
+    def __missing__(self, name):
+        value = np.ascontiguousarray(self.state_dict[name].detach().cpu().numpy(), dtype=np.float32)
+        self[name] = value
+        return value
+
+    def __contains__(self, name):
+        return dict.__contains__(self, name) or name in self.state_dict
+
+    def get(self, name, default=None):
+        return self[name] if name in self else default
+
+# bump whenever a change to the parser alters the network it builds, cached plans are keyed on it
+_CACHE_VERSION = 2
+
+def _device_tag():
+    if cuda is None:
+        return ""
+    try:
+        cuda.init()
+        device = cuda.Device(0)
+    except cuda.Error:
+        return ""
+    return "%s sm_%d%d" % ((device.name(),) + device.compute_capability())
+
+def _ensure_cuda_context():
+    # page-locked allocations need a current context, which only pycuda.autoinit sets up for us
+    try:
+        cuda.init()
+        if cuda.Context.get_current() is None:
+            cuda.Device(0).retain_primary_context().push()
+    except cuda.Error as e:
+        raise RuntimeError("pin_weights needs a usable cuda device: %s" % e)
+
+class InferRunner(object):
+    # replays the engine from a captured cuda graph, one launch per inference instead of one per kernel
+    def __init__(self, engine):
+        self.engine = engine
+        self.context = engine.create_execution_context()
+        self.stream = cuda.Stream()
+        # the named tensor api (execute_async_v3) only drives explicit batch engines
+        self.use_v3 = hasattr(engine, 'num_io_tensors') and not engine.has_implicit_batch_dimension
+        self.inputs = []
+        self.outputs = []
+        self.bindings = []
+        self.graph_exec = None
+        self.bind_buffers()
+
+    def bind_buffers(self):
+        # allocate and bind every io tensor once, infer() then only copies and enqueues
+        engine = self.engine
+        if self.use_v3:
+            for idx in range(engine.num_io_tensors):
+                name = engine.get_tensor_name(idx)
+                shape = engine.get_tensor_shape(name)
+                host_mem = cuda.pagelocked_empty(trt.volume(shape), dtype=trt.nptype(engine.get_tensor_dtype(name)))
+                device_mem = cuda.mem_alloc(host_mem.nbytes)
+                if engine.get_tensor_mode(name) == trt.TensorIOMode.INPUT:
+                    self.context.set_input_shape(name, shape)
+                    self.inputs.append((host_mem, device_mem))
+                else:
+                    self.outputs.append((host_mem, device_mem))
+                self.context.set_tensor_address(name, int(device_mem))
+        else:
+            for idx, binding in enumerate(engine):
+                size = trt.volume(engine.get_binding_shape(binding))
+                host_mem = cuda.pagelocked_empty(size, dtype=trt.nptype(engine.get_binding_dtype(idx)))
+                device_mem = cuda.mem_alloc(host_mem.nbytes)
+                self.bindings.append(int(device_mem))
+                if engine.binding_is_input(binding):
+                    self.inputs.append((host_mem, device_mem))
+                else:
+                    self.outputs.append((host_mem, device_mem))
+
+    def enqueue(self):
+        if self.use_v3:
+            self.context.execute_async_v3(stream_handle=self.stream.handle)
+        elif self.engine.has_implicit_batch_dimension:
+            self.context.execute_async(batch_size=1, bindings=self.bindings, stream_handle=self.stream.handle)
+        else:
+            # explicit batch engine on tensorrt without the named tensor api
+            self.context.execute_async_v2(bindings=self.bindings, stream_handle=self.stream.handle)
+
+    def infer(self, *arrays):
+        for (host_mem, device_mem), array in zip(self.inputs, arrays):
+            np.copyto(host_mem, np.asarray(array).ravel())
+            cuda.memcpy_htod_async(device_mem, host_mem, self.stream)
+
+        if not hasattr(self.stream, 'begin_capture'):
+            # pycuda without the cuda graph api, enqueue every inference
+            self.enqueue()
+        else:
+            if self.graph_exec is None:
+                # run once uncaptured so lazy allocations inside tensorrt stay out of the graph
+                self.enqueue()
+                self.stream.synchronize()
+                self.stream.begin_capture()
+                self.enqueue()
+                self.graph_exec = self.stream.end_capture().instantiate()
+
+            self.graph_exec.launch(self.stream)
+        for host_mem, device_mem in self.outputs:
+            cuda.memcpy_dtoh_async(host_mem, device_mem, self.stream)
+        self.stream.synchronize()
+
+        # the page-locked buffers are rewritten by the next launch, hand out copies
+        return [host_mem.copy() for host_mem, _ in self.outputs]
+
+def _mk_caffe(name, type_, tops, bottoms):
+    # only the fields the debug prototxt shows are filled in
+    caffe_layer = pb2.LayerParameter()
+    caffe_layer.name = name
+    caffe_layer.type = type_
+    caffe_layer.top.extend(tops)
+    caffe_layer.bottom.extend(bottoms)
+    return caffe_layer
 
 class PytorchTensorRTParser(Parser):
-    def __init__(self, model, input_shape, opset_version, fuse=False):
+    def __init__(self, model, input_shape, opset_version, fuse=False, precision='fp32', calibrator=None, enable_cache=False, engine_cache_dir=None, timing_cache_path=None, emit_debug_proto=False, pin_weights=False, max_aux_streams=0, use_onnx_parser=False):
         super(PytorchTensorRTParser, self).__init__()
+        assert precision in ('fp32', 'fp16', 'int8'), "unsupported precision %s" % precision
+        assert precision != 'int8' or calibrator is not None, "int8 precision needs a calibrator"
         self.fuse = fuse
+        self.precision = precision
+        self.calibrator = calibrator
+        self._weight_dtype = np.float32
         self.model = model
         if self.fuse:
-            self.fuse_all_conv_bn(self.model)
+            self.model = self.fuse_all_conv_bn(self.model)
         self.pytorch_graph = PytorchGraph(self.model, opset_version)
         self.input_shape = input_shape
         self.opset_version = opset_version
         self.pytorch_graph.build(self.input_shape, self.opset_version)
         self.state_dict = self.pytorch_graph.state_dict
+        self._weights_np = _NumpyWeights(self.state_dict)
         self.shape_dict = self.pytorch_graph.shape_dict
+        # top name -> output ITensor, get_output(0) is fetched once by the producing handler
         self.named_layer = dict()
         self.named_node = dict()
         self.main_layers = []
+        self._main_tops = set()
+        self._anchors = []
+        self._folded_bn = set()
+        # shuffle output name -> (layer, last filled stage, last permutation), see _shuffle_producer
+        self._shuffle_layer = dict()
+        self._emit_debug_proto = emit_debug_proto
+        self._dispatch = {k: getattr(self, "rename_" + v, self.rename_Common) for k, v in layer_map.items()}
+        self.engine_cache_dir = engine_cache_dir
+        self.timing_cache_path = timing_cache_path
+        self.pin_weights = pin_weights and cuda is not None
+        if self.pin_weights:
+            _ensure_cuda_context()
+        self.max_aux_streams = max_aux_streams
+        self.use_onnx_parser = use_onnx_parser
+        self._build_failed = False
+        self._cache_key = self._engine_cache_key() if enable_cache else None
+
+    def _engine_cache_key(self):
+        h = hashlib.sha1()
+        for name in sorted(self.state_dict):
+            arr = self._weights_np[name]
+            h.update(name.encode())
+            h.update(np.asarray(arr.shape, dtype=np.int64).tobytes())
+            if arr.size:
+                h.update(memoryview(arr).cast('B')) # zero-copy view of the contiguous buffer
+        h.update(repr((self.input_shape, self.opset_version, self.precision, self.fuse, self.use_onnx_parser,
+                       self.max_aux_streams)).encode())
+        if self.calibrator is not None:
+            # int8 scales come from the calibration data, only a calibration cache pins them down
+            calibration_cache = self.calibrator.read_calibration_cache()
+            if not calibration_cache:
+                logger.warning("int8 calibrator has no calibration cache, engine caching disabled.")
+                return None
+            h.update(type(self.calibrator).__name__.encode())
+            h.update(bytes(calibration_cache))
+        # plans are only valid for the tensorrt release and gpu arch that built them
+        h.update(trt.__version__.encode())
+        h.update(_device_tag().encode())
+        h.update(str(_CACHE_VERSION).encode())
+        graph = self.pytorch_graph
+        for name in graph.topological_sort:
+            node = graph.get_node(name)
+            h.update(repr((node.type, node.in_edges, node.output_shape)).encode())
+            for key, value in sorted(getattr(node, 'attrs', {}).items()):
+                h.update(key.encode())
+                if isinstance(value, torch.Tensor):
+                    value = np.ascontiguousarray(value.detach().cpu().numpy())
+                    h.update(repr((value.dtype.str, value.shape)).encode())
+                    h.update(value.tobytes())
+                else:
+                    h.update(repr(value).encode())
+
+        return h.hexdigest()
 
     def run(self, dest_path):
-        engine = self.gen_IR(dest_path)
-        self.save_to_file(engine, dest_path + ".trt")
+        if self._cache_key is None:
+            self.engine = self.gen_IR(dest_path)
+            self.save_to_file(self.engine, dest_path + ".trt")
+            return
+
+        cache_dir = self.engine_cache_dir or dest_path + ".trt.cache"
+        cache_file = os.path.join(cache_dir, self._cache_key + ".plan")
+        if os.path.exists(cache_file):
+            with open(cache_file, 'rb') as f:
+                plan = f.read()
+            runtime = trt.Runtime(trt.Logger(trt.Logger.WARNING))
+            engine = runtime.deserialize_cuda_engine(plan)
+            if engine is not None:
+                logger.info("reuse cached engine %s" % cache_file)
+                self.engine = engine
+                with open(dest_path + ".trt", 'wb') as f:
+                    f.write(plan)
+                return
+
+        self.engine = self.gen_IR(dest_path)
+        self.save_to_file(self.engine, dest_path + ".trt")
+        if self._build_failed:
+            logger.warning("network is incomplete, engine not cached.")
+            return
+
+        os.makedirs(cache_dir, exist_ok=True)
+        # write then rename so a concurrent reader never sees a partial plan
+        self.save_to_file(self.engine, cache_file + ".tmp")
+        os.replace(cache_file + ".tmp", cache_file)
+
+    def build_runner(self):
+        assert cuda is not None, "InferRunner needs pycuda"
+        return InferRunner(self.engine)
 
     def save_to_file(self, engine, filename):
         with open(filename, 'wb') as f:
@@ -91,39 +336,128 @@ class PytorchTensorRTParser(Parser):
         return self.pytorch_graph
 
     def fuse_all_conv_bn(self, model):
-        stack = []
-        for name, module in model.named_children():
-            if list(module.named_children()):
-                self.fuse_all_conv_bn(module)
-
-            if isinstance(module, nn.BatchNorm2d):
-                if not stack:
-                    continue
-                if isinstance(stack[-1][1], nn.Conv2d):
-                    setattr(model, stack[-1][0], fuse_conv_bn_eval(stack[-1][1], module))
-                    setattr(model, name, nn.Identity())
-
-            elif isinstance(module, nn.BatchNorm1d):
-                if not stack:
-                    continue                
-                if isinstance(stack[-1][1], nn.Linear):
-                    setattr(model, stack[-1][0], fuse_linear_bn_eval(stack[-1][1], module))
-                    setattr(model, name, nn.Identity())                    
-            else:
-                stack.append((name, module))
+        assert not model.training, "conv/bn fusion is only valid in eval mode"
 
-    def is_main(self, inputs):
-        for input in inputs:
-            find = False
-            for layer in self.main_layers:
-                if input in layer.top:
-                    find = True
-                    break
+        try:
+            gm = torch.fx.symbolic_trace(model)
+        except Exception as e:
+            logger.info("torch.fx can not trace the model (%s), fuse sibling conv/bn modules only." % e)
+            self.fuse_sibling_conv_bn(model)
+            return model
+
+        modules = dict(gm.named_modules())
+        calls = {}
+        for node in gm.graph.nodes:
+            if node.op == 'call_module':
+                calls[node.target] = calls.get(node.target, 0) + 1
+
+        fusers = {nn.BatchNorm2d: (nn.Conv2d, fuse_conv_bn_eval), nn.BatchNorm1d: (nn.Linear, fuse_linear_bn_eval)}
+        for node in list(gm.graph.nodes):
+            if node.op != 'call_module' or type(modules[node.target]) not in fusers:
+                continue
+            prev_type, fuser = fusers[type(modules[node.target])]
+            prev = node.args[0]
+            if not isinstance(prev, torch.fx.Node) or prev.op != 'call_module' or not isinstance(modules[prev.target], prev_type):
+                continue
+            # the unfused output must not be needed elsewhere, nor the modules called twice
+            if len(prev.users) != 1 or calls[prev.target] != 1 or calls[node.target] != 1:
+                continue
+
+            fused = fuser(modules[prev.target], modules[node.target])
+            parent_name, _, name = prev.target.rpartition('.')
+            setattr(modules[parent_name], name, fused)
+            modules[prev.target] = fused
+            node.replace_all_uses_with(prev)
+            gm.graph.erase_node(node)
+
+        gm.graph.lint()
+        # drop the erased bn modules, their parameters would stay in the state_dict and the cache key
+        gm.delete_all_unused_submodules()
+        gm.recompile()
+
+        return gm
+
+    def fuse_sibling_conv_bn(self, model):
+        pairs = []
+        for parent in [module for _, module in model.named_modules()]:
+            prev_name, prev = None, None
+            for name, module in parent._modules.items():
+                if isinstance(module, nn.BatchNorm2d):
+                    if isinstance(prev, nn.Conv2d):
+                        pairs.append((parent, prev_name, name, fuse_conv_bn_eval, prev, module))
+                        prev_name, prev = None, None
+                elif isinstance(module, nn.BatchNorm1d):
+                    if isinstance(prev, nn.Linear):
+                        pairs.append((parent, prev_name, name, fuse_linear_bn_eval, prev, module))
+                        prev_name, prev = None, None
+                else:
+                    prev_name, prev = name, module
+
+        # every pair folds independently and torch drops the GIL inside the tensor math
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            fused = list(executor.map(lambda pair: pair[3](pair[4], pair[5]), pairs))
+
+        for (parent, prev_name, name, _, _, _), module in zip(pairs, fused):
+            parent._modules[prev_name] = module
+            parent._modules[name] = nn.Identity()
+
+    def fold_conv_bn(self, nodes):
+        # graph level counterpart of fuse_all_conv_bn, catches bn applied outside a conv/bn module pair
+        conv_uses = {}
+        for node in nodes:
+            if node.type == 'onnx::Conv':
+                conv_uses[node.weights_name] = conv_uses.get(node.weights_name, 0) + 1
+
+        for node in nodes:
+            if node.type != 'onnx::BatchNormalization' or node.weights_name == "" or node.name in self._folded_bn:
+                continue
+            conv = self.named_node.get(node.in_edges[0])
+            if conv is None or conv.type != 'onnx::Conv' or conv.weights_name == "":
+                continue
+            # the unfolded conv output must not be needed elsewhere, nor its weights shared
+            if len(conv.out_edges) != 1 or conv_uses[conv.weights_name] != 1:
+                continue
+
+            weights = self._weights_np
+            conv_weight_name = f"{conv.weights_name}.weight"
+            conv_bias_name = f"{conv.weights_name}.bias"
+            weight = weights[conv_weight_name]
+            mean = weights[f"{node.weights_name}.running_mean"]
+            variance = weights[f"{node.weights_name}.running_var"]
+            scale = weights[f"{node.weights_name}.weight"]
+            bias = weights.get(f"{node.weights_name}.bias", np.zeros_like(mean))
+            conv_bias = weights.get(conv_bias_name, np.zeros_like(mean))
+            eps = np.float32(node.attrs.get('epsilon', 1e-05))
+
+            # new arrays only, the originals may share memory with the torch parameters
+            a = scale / np.sqrt(variance + eps)
+            weights[conv_weight_name] = np.ascontiguousarray(weight * a.reshape([-1] + [1] * (weight.ndim - 1)))
+            weights[conv_bias_name] = np.ascontiguousarray((conv_bias - mean) * a + bias)
+            self._folded_bn.add(node.name)
+
+    def _add_main(self, name, type_, tops, bottoms):
+        if self._emit_debug_proto:
+            self.main_layers.append(_mk_caffe(name.replace(".", ""), type_, tops, bottoms))
+        self._main_tops.update(tops)
+
+    def _shuffle_producer(self, source_node):
+        # IShuffleLayer runs first_transpose -> reshape_dims -> second_transpose (stages 1, 2, 3),
+        # a reshape/permute can be folded into the shuffle feeding it if nothing else reads that output
+        in_edge = source_node.in_edges[0]
+        if in_edge not in self._shuffle_layer or in_edge in self.pytorch_graph.output_layers:
+            return None
+        producer = self.named_node.get(in_edge)
+        if producer is None or len(producer.out_edges) != 1:
+            return None
 
-            if find == False:
-                return False
+        return self._shuffle_layer.pop(in_edge)
 
-        return True
+    def _alias(self, source_node, in_edge, caffe_type):
+        self._add_main(source_node.name, caffe_type, [source_node.name], [in_edge])
+        self.named_layer[source_node.name] = self.named_layer[in_edge]
+
+    def is_main(self, inputs):
+        return all(input in self._main_tops for input in inputs)
 
     def save_to_proto(self, net, filename):
         with open(filename, 'wb') as f:
@@ -132,54 +466,127 @@ class PytorchTensorRTParser(Parser):
     def gen_IR(self, dest_path):
         TRT_LOGGER = trt.Logger(trt.Logger.WARNING)
         self.builder = trt.Builder(TRT_LOGGER)
-        self.network = self.builder.create_network()
         self.config = self.builder.create_builder_config()
         self.runtime = trt.Runtime(TRT_LOGGER)        
         self.config.max_workspace_size = (1 << 30)
+        try:
+            # every auxiliary stream gets its own scratch memory
+            self.config.max_aux_streams = self.max_aux_streams
+        except AttributeError:
+            pass
         self.builder.max_batch_size = 1
 
-        try:
-            for node in self.src_graph.topological_sort:
-                current_node = self.src_graph.get_node(node)
-                self.named_node[current_node.real_name] = current_node
-                onnx_node_type = current_node.type
-                node_type = layer_map[onnx_node_type]
-
-                if hasattr(self, "rename_" + node_type):
-                    func = getattr(self, "rename_" + node_type)
-                    func(current_node)
-                else:
-                    self.rename_Common(current_node)
-        except Exception as e:
-            logger.info(e)
-        finally:
-            text_net = pb2.NetParameter()
-
-            for layer in self.main_layers:
-                layer.name = layer.name.replace(".", "")
-                layer_proto = pb2.LayerParameter()
-                layer_proto.CopyFrom(layer)
-                del layer_proto.blobs[:]
-                text_net.layer.extend([layer_proto])
-            self.save_to_proto(text_net, dest_path + "_debug.prototxt")
-
-        for layer_name in self.pytorch_graph.output_layers:
-            node = self.named_node[layer_name]
-
-            if node.type in ['onnx::Split']:
-                for idx, output_id in enumerate(node.output_ids):     
-                    output_name = node.name + ':' + output_id 
-                    self.network.mark_output(tensor=self.named_layer[output_name])
-            else:
-                if layer_name not in self.named_layer.keys():
-                    continue
-                self.network.mark_output(tensor=self.named_layer[layer_name])
+        if self.precision == 'fp16':
+            if not self.builder.platform_has_fast_fp16:
+                logger.warning("This GPU has no fast fp16 path, the fp16 engine may be slower than fp32.")
+            self.config.set_flag(trt.BuilderFlag.FP16)
+            self._weight_dtype = np.float16
+        elif self.precision == 'int8':
+            if not self.builder.platform_has_fast_int8:
+                logger.warning("This GPU has no fast int8 path, the int8 engine may be slower than fp32.")
+            self.config.set_flag(trt.BuilderFlag.INT8)
+            self.config.int8_calibrator = self.calibrator
+
+        timing_cache = None
+        if self.timing_cache_path is not None:
+            data = b""
+            if os.path.exists(self.timing_cache_path):
+                with open(self.timing_cache_path, 'rb') as f:
+                    data = f.read()
+            try:
+                timing_cache = self.config.create_timing_cache(data)
+                self.config.set_timing_cache(timing_cache, ignore_mismatch=False)
+            except AttributeError:
+                logger.warning("TensorRT %s has no timing cache support." % trt.__version__)
+                timing_cache = None
+
+        if not (self.use_onnx_parser and self.parse_onnx(TRT_LOGGER)):
+            self.network = self.builder.create_network()
+            self.populate_network(dest_path)
 
         self.plan = self.builder.build_serialized_network(self.network, self.config)
+        self._anchors = []
+        if timing_cache is not None and self.plan is not None:
+            with open(self.timing_cache_path + ".tmp", 'wb') as f:
+                f.write(bytes(timing_cache.serialize()))
+            os.replace(self.timing_cache_path + ".tmp", self.timing_cache_path)
         engine = self.runtime.deserialize_cuda_engine(self.plan)
 
         return engine
 
+    def parse_onnx(self, trt_logger):
+        # the onnx parser needs an explicit batch network, the rename_* path below stays implicit batch
+        self.network = self.builder.create_network(1 << int(trt.NetworkDefinitionCreationFlag.EXPLICIT_BATCH))
+        if isinstance(self.input_shape, tuple):
+            dummy_input = tuple(torch.ones(each) for each in self.input_shape)
+            names = ["data_" + str(idx) for idx in range(len(self.input_shape))]
+        else:
+            dummy_input = (torch.ones(self.input_shape), )
+            names = ["data"]
+
+        onnx_model = io.BytesIO()
+        try:
+            torch.onnx.export(self.model, dummy_input, onnx_model, input_names=names,
+                              opset_version=self.opset_version, do_constant_folding=True)
+        except Exception as e:
+            logger.info("onnx export failed (%s), fall back to the rename_* path." % e)
+            return False
+
+        parser = trt.OnnxParser(self.network, trt_logger)
+        if not parser.parse(onnx_model.getvalue()):
+            for idx in range(parser.num_errors):
+                logger.info(parser.get_error(idx))
+            logger.info("TensorRT onnx parser failed, fall back to the rename_* path.")
+            return False
+
+        return True
+
+    def populate_network(self, dest_path):
+        self._build_failed = False
+        try:
+            graph = self.pytorch_graph
+            nodes = [graph.get_node(node) for node in graph.topological_sort]
+            self.named_node = {current_node.real_name: current_node for current_node in nodes}
+            self.fold_conv_bn(nodes)
+            for current_node in nodes:
+                func = self._dispatch.get(current_node.type, self.rename_Common)
+                func(current_node)
+        except Exception as e:
+            logger.info(e)
+            self._build_failed = True
+        finally:
+            if self._emit_debug_proto:
+                # debug layers never carry blobs, so they go out as they are
+                text_net = pb2.NetParameter()
+                text_net.layer.extend(self.main_layers)
+                self.save_to_proto(text_net, dest_path + "_debug.prototxt")
+
+        # dict.fromkeys de-duplicates while keeping the output order, skipped nodes have no tensor
+        for layer_name in dict.fromkeys(self.pytorch_graph.output_layers):
+            node = self.named_node.get(layer_name)
+            if node is not None and node.type in ['onnx::Split']:
+                output_names = [node.name + ':' + output_id for output_id in node.output_ids]
+            else:
+                output_names = [layer_name]
+
+            for output_name in output_names:
+                tensor = self.named_layer.get(output_name)
+                if tensor is not None:
+                    self.network.mark_output(tensor=tensor)
+
+    def _trt_weights(self, array):
+        # trt.Weights only borrows the buffer, keep it alive until the engine is built
+        if array.dtype.kind == 'f':
+            array = array.astype(self._weight_dtype, copy=False)
+        if self.pin_weights:
+            # page-locked staging lets the builder upload the weights with dma
+            pinned = cuda.pagelocked_empty(array.shape, array.dtype)
+            np.copyto(pinned, array)
+            array = pinned
+        assert array.flags['C_CONTIGUOUS']
+        self._anchors.append(array)
+        return trt.Weights(array)
+
     ##########
     # Layers #
     ##########
@@ -190,14 +597,10 @@ class PytorchTensorRTParser(Parser):
         return None
 
     def rename_Data(self, source_node):
-        tensor = self.network.add_input(source_node.name, dtype=trt.float32, shape=source_node.output_shape)
-
-        caffe_layer = pb2.LayerParameter()
-        caffe_layer.name = source_node.name
-        caffe_layer.type = 'Input'    
-        caffe_layer.top.append(source_node.name)
+        dtype = trt.float16 if self.precision == 'fp16' else trt.float32
+        tensor = self.network.add_input(source_node.name, dtype=dtype, shape=source_node.output_shape)
 
-        self.main_layers.append(caffe_layer)
+        self._add_main(source_node.name, 'Input', [source_node.name], [])
         self.named_layer[source_node.name] = tensor
         tensor.name = source_node.name
        
@@ -209,20 +612,7 @@ class PytorchTensorRTParser(Parser):
 
         attr = source_node.attrs
 
-        if len(attr['pads']) == 4:
-            pads = (attr['pads'][0], attr['pads'][1])
-        elif len(attr['pads']) == 2:
-            pads = (attr['pads'][0], attr['pads'][1])
-
-        if 'strides' not in attr:
-            strides = None
-        else:
-            strides = (attr['strides'][0], attr['strides'][1])
-
-        if 'kernel_shape' not in attr:
-            kernel_shape = None 
-        else:
-            kernel_shape = (attr['kernel_shape'][0], attr['kernel_shape'][1])
+        pre_padding, post_padding, strides, kernel_shape = _conv_attrs(attr)
 
         if 'group' not in attr:
             num_groups = 1
@@ -238,36 +628,27 @@ class PytorchTensorRTParser(Parser):
             bias_name = 'bias'
             weights_name = 'weight'
         else:
-            bias_name = '{0}.bias'.format(source_node.weights_name)
-            weights_name = '{0}.weight'.format(source_node.weights_name)
-
-        weight = self.state_dict[weights_name]
+            bias_name = f"{source_node.weights_name}.bias"
+            weights_name = f"{source_node.weights_name}.weight"
 
-        weight = weight.numpy()
-
-        self.set_weight(source_node.name, 'weights', weight)
+        weight = self._weights_np[weights_name]
         num_filter = list(weight.shape)[0]
 
         # handle bias
-        if bias_name in self.state_dict:
-            bias = self.state_dict[bias_name].numpy()
+        if bias_name in self._weights_np:
+            bias = self._trt_weights(self._weights_np[bias_name])
         else:
             bias = trt.Weights()
 
-        layer = self.network.add_convolution(input=self.named_layer[source_node.in_edges[0]], num_output_maps=num_filter, kernel_shape=kernel_shape, kernel=weight, bias=bias)    
+        layer = self.network.add_convolution(input=self.named_layer[source_node.in_edges[0]], num_output_maps=num_filter, kernel_shape=kernel_shape, kernel=self._trt_weights(weight), bias=bias)    
         layer.stride = strides
-        layer.padding = pads
+        layer.pre_padding = pre_padding
+        layer.post_padding = post_padding
         layer.num_groups = num_groups
         layer.dilation = dilations
         layer.name = source_node.name
 
-        caffe_layer = pb2.LayerParameter()
-        caffe_layer.name = source_node.name
-        caffe_layer.type = 'Convolution'       
-        caffe_layer.top.append(source_node.name)
-        caffe_layer.bottom.append(source_node.in_edges[0])
-
-        self.main_layers.append(caffe_layer)
+        self._add_main(source_node.name, 'Convolution', [source_node.name], source_node.in_edges[0:1])
         self.named_layer[source_node.name] = layer.get_output(0)
 
         return layer
@@ -278,13 +659,7 @@ class PytorchTensorRTParser(Parser):
 
         layer = self.network.add_activation(self.named_layer[source_node.in_edges[0]], type=trt.ActivationType.RELU)
         layer.name = source_node.name
-        caffe_layer = pb2.LayerParameter()
-        caffe_layer.name = source_node.name
-        caffe_layer.type = 'ReLU'     
-        caffe_layer.top.append(source_node.name)
-        caffe_layer.bottom.append(source_node.in_edges[0])
-
-        self.main_layers.append(caffe_layer)
+        self._add_main(source_node.name, 'ReLU', [source_node.name], source_node.in_edges[0:1])
         self.named_layer[source_node.name] = layer.get_output(0)   
 
         return layer
@@ -294,41 +669,19 @@ class PytorchTensorRTParser(Parser):
             return None
         
         attr = source_node.attrs
-        kwargs = dict()
 
-        if len(attr['pads']) == 4:
-            pads = (attr['pads'][0], attr['pads'][1])
-        elif len(attr['pads']) == 2:
-            pads = (attr['pads'][0], attr['pads'][1])
-
-        if 'strides' not in attr:
-            kwargs['strides'] = [1] + [1, 1] + [1]
-            layer.pooling_param.stride = 1
-        else:
-            strides = (attr['strides'][0], attr['strides'][1]) 
-
-        if 'kernel_shape' not in attr:
-            kwargs['kernel_shape'] = [1] + [1, 1] + [1]
-            layer.pooling_param.kernel_size.extend(1)
-        else:
-            kwargs['kernel_shape'] = [1] + attr['kernel_shape'] + [1]
-            kernel_shape = (attr['kernel_shape'][0], attr['kernel_shape'][1])            
+        pre_padding, post_padding, strides, kernel_shape = _conv_attrs(attr)
 
         layer = self.network.add_pooling(self.named_layer[source_node.in_edges[0]], trt.PoolingType.MAX, window_size=kernel_shape)
         layer.stride = strides
-        layer.padding = pads
+        layer.pre_padding = pre_padding
+        layer.post_padding = post_padding
         if 'ceil_mode' in attr:
             if attr['ceil_mode'] == 1:
                 layer.padding_mode = trt.PaddingMode.EXPLICIT_ROUND_UP
 
         layer.name = source_node.name
-        caffe_layer = pb2.LayerParameter()
-        caffe_layer.name = source_node.name
-        caffe_layer.type = 'Pooling'       
-        caffe_layer.top.append(source_node.name)
-        caffe_layer.bottom.append(source_node.in_edges[0])
-
-        self.main_layers.append(caffe_layer)
+        self._add_main(source_node.name, 'Pooling', [source_node.name], source_node.in_edges[0:1])
         self.named_layer[source_node.name] = layer.get_output(0)
 
         return layer
@@ -340,14 +693,7 @@ class PytorchTensorRTParser(Parser):
         layer = self.network.add_elementwise(self.named_layer[source_node.in_edges[0]], self.named_layer[source_node.in_edges[1]], trt.ElementWiseOperation.SUM)
         layer.name = source_node.name 
         
-        caffe_layer = pb2.LayerParameter()
-        caffe_layer.name = source_node.name     
-        caffe_layer.type = 'Eltwise'     
-        caffe_layer.top.append(source_node.name)
-        caffe_layer.bottom.append(source_node.in_edges[0])
-        caffe_layer.bottom.append(source_node.in_edges[1])
-
-        self.main_layers.append(caffe_layer)
+        self._add_main(source_node.name, 'Eltwise', [source_node.name], source_node.in_edges[0:2])
         self.named_layer[source_node.name] = layer.get_output(0)   
 
         return layer
@@ -355,17 +701,14 @@ class PytorchTensorRTParser(Parser):
     def rename_GlobalAveragePool(self, source_node):
         if not self.is_main(source_node.in_edges[0:1]):
             return None   
+
+        input_ = self.named_layer[source_node.in_edges[0]]
         
-        kernel_shape  = self.named_layer[source_node.in_edges[0]].shape
-        layer = self.network.add_pooling(self.named_layer[source_node.in_edges[0]], trt.PoolingType.AVERAGE, window_size=kernel_shape[2:])
+        rank = len(input_.shape)
+        axes = (1 << (rank - 2)) | (1 << (rank - 1)) # bit wise, the two spatial dims
+        layer = self.network.add_reduce(input_, trt.ReduceOperation.AVG, axes=axes, keep_dims=True)
         layer.name = source_node.name
-        caffe_layer = pb2.LayerParameter()
-        caffe_layer.name = source_node.name   
-        caffe_layer.type = 'Pooling'       
-        caffe_layer.top.append(source_node.name)
-        caffe_layer.bottom.append(source_node.in_edges[0])
-
-        self.main_layers.append(caffe_layer)
+        self._add_main(source_node.name, 'Pooling', [source_node.name], source_node.in_edges[0:1])
         self.named_layer[source_node.name] = layer.get_output(0)
 
         return layer
@@ -374,61 +717,62 @@ class PytorchTensorRTParser(Parser):
         if not self.is_main(source_node.in_edges[0:1]):
             return None
 
-        caffe_layer = pb2.LayerParameter()
-        caffe_layer.name = source_node.name  
-        caffe_layer.type = 'Flatten'        
-        caffe_layer.top.append(source_node.name)
-        caffe_layer.bottom.append(source_node.in_edges[0])
+        input_ = self.named_layer[source_node.in_edges[0]]
+        shape = tuple(input_.shape)
+        axis = source_node.attrs.get('axis', 1)
 
-        self.main_layers.append(caffe_layer)
-        self.named_layer[source_node.name] = self.named_layer[source_node.in_edges[0]]
+        # add_fully_connected flattens its input itself, so a flatten feeding only Gemm is a no-op
+        consumers = [self.named_node.get(name) for name in source_node.out_edges]
+        if len(shape) <= 2 or (consumers and all(node is not None and node.type == 'onnx::Gemm' for node in consumers)):
+            self._main_tops.add(source_node.name)
+            self.named_layer[source_node.name] = input_
+            return None
+
+        layer = self.network.add_shuffle(input_)
+        layer.reshape_dims = (int(np.prod(shape[:axis])), -1)
+        layer.name = source_node.name
+        self._add_main(source_node.name, 'Flatten', [source_node.name], source_node.in_edges[0:1])
+        self.named_layer[source_node.name] = layer.get_output(0)
 
-        return
+        return layer
 
     def rename_FullyConnected(self, source_node):
         if not self.is_main(source_node.in_edges[0:1]):
             return None
+
+        network = self.network
+        input_ = self.named_layer[source_node.in_edges[0]]
         
         if source_node.weights_name == "":
             bias_name = 'bias'
             weights_name = 'weight'
         else:
-            bias_name = '{0}.bias'.format(source_node.weights_name)
-            weights_name = '{0}.weight'.format(source_node.weights_name)
-
-        W = self.state_dict[weights_name].numpy().transpose()
+            bias_name = f"{source_node.weights_name}.bias"
+            weights_name = f"{source_node.weights_name}.weight"
 
-        _, output_channels = W.shape
+        weight = self._weights_np[weights_name]
+        output_channels = weight.shape[0]
+        kernel = self._trt_weights(weight)
 
-        weight = self.state_dict[weights_name].numpy()
-
-        self.set_weight(source_node.name, 'weights', W )
-
-        if bias_name in self.state_dict:
-            bias = self.state_dict[bias_name].numpy()
+        if bias_name in self._weights_np:
+            bias = self._trt_weights(self._weights_np[bias_name])
         else:
             bias = trt.Weights()
         
-        if(len(self.named_layer[source_node.in_edges[0]].shape) == 4):
-            layer = self.network.add_fully_connected(input=self.named_layer[source_node.in_edges[0]], num_outputs=output_channels, kernel=weight, bias=bias)
+        if(len(input_.shape) == 4):
+            layer = network.add_fully_connected(input=input_, num_outputs=output_channels, kernel=kernel, bias=bias)
         else:
-            shuffle_layer = self.network.add_shuffle(self.named_layer[source_node.in_edges[0]])
-            shuffle_layer.reshape_dims = tuple(self.named_layer[source_node.in_edges[0]].shape) + (1, 1)
+            shuffle_layer = network.add_shuffle(input_)
+            shuffle_layer.reshape_dims = tuple(input_.shape) + (1, 1)
 
-            fc_layer = self.network.add_fully_connected(input=shuffle_layer.get_output(0), num_outputs=output_channels, kernel=weight, bias=bias)
+            fc_layer = network.add_fully_connected(input=shuffle_layer.get_output(0), num_outputs=output_channels, kernel=kernel, bias=bias)
         
-            layer = self.network.add_shuffle(fc_layer.get_output(0))
+            layer = network.add_shuffle(fc_layer.get_output(0))
             layer.reshape_dims = tuple(source_node.output_shape[1:])
 
         layer.name = source_node.name         
         
-        caffe_layer = pb2.LayerParameter()
-        caffe_layer.name = source_node.name   
-        caffe_layer.type = 'InnerProduct'       
-        caffe_layer.top.append(source_node.name)
-        caffe_layer.bottom.append(source_node.in_edges[0])
-
-        self.main_layers.append(caffe_layer)
+        self._add_main(source_node.name, 'InnerProduct', [source_node.name], source_node.in_edges[0:1])
         self.named_layer[source_node.name] = layer.get_output(0)   
 
         return layer
@@ -440,13 +784,7 @@ class PytorchTensorRTParser(Parser):
         layer = self.network.add_activation(self.named_layer[source_node.in_edges[0]], type=trt.ActivationType.SIGMOID)
         layer.name = source_node.real_name
 
-        caffe_layer = pb2.LayerParameter()
-        caffe_layer.name = source_node.name  
-        caffe_layer.type = 'Sigmoid'      
-        caffe_layer.top.append(source_node.name)
-        caffe_layer.bottom.append(source_node.in_edges[0])
-
-        self.main_layers.append(caffe_layer)
+        self._add_main(source_node.name, 'Sigmoid', [source_node.name], source_node.in_edges[0:1])
         self.named_layer[source_node.name] = layer.get_output(0)
 
         return layer
@@ -456,16 +794,10 @@ class PytorchTensorRTParser(Parser):
             return None
         
         attr = source_node.attrs
-        axes = np.power(2, attr['axes'][0]) # bit wise 
+        axes = 1 << int(attr['axes'][0]) # bit wise
         layer = self.network.add_reduce(self.named_layer[source_node.in_edges[0]], trt.ReduceOperation.SUM, axes=axes, keep_dims=True)
         layer.name = source_node.name
-        caffe_layer = pb2.LayerParameter()
-        caffe_layer.name = source_node.name   
-        caffe_layer.type = 'Pooling'      
-        caffe_layer.top.append(source_node.name)
-        caffe_layer.bottom.append(source_node.in_edges[0])
-
-        self.main_layers.append(caffe_layer)
+        self._add_main(source_node.name, 'Pooling', [source_node.name], source_node.in_edges[0:1])
         self.named_layer[source_node.name] = layer.get_output(0)   
 
         return layer
@@ -476,13 +808,7 @@ class PytorchTensorRTParser(Parser):
         
         layer = self.network.add_elementwise(self.named_layer[source_node.in_edges[0]], self.named_layer[source_node.in_edges[1]], trt.ElementWiseOperation.DIV)
         layer.name = source_node.name
-        caffe_layer = pb2.LayerParameter()
-        caffe_layer.name = source_node.name      
-        caffe_layer.type = 'Eltwise'   
-        caffe_layer.top.append(source_node.name)
-        caffe_layer.bottom.append(source_node.in_edges[0])
-
-        self.main_layers.append(caffe_layer)
+        self._add_main(source_node.name, 'Eltwise', [source_node.name], source_node.in_edges[0:1])
         self.named_layer[source_node.name] = layer.get_output(0)   
         
         return layer
@@ -490,24 +816,19 @@ class PytorchTensorRTParser(Parser):
     def rename_Mul(self, source_node):
         if not self.is_main(source_node.in_edges[0:1]):
             return None
+
+        input_ = self.named_layer[source_node.in_edges[0]]
         
         attr = source_node.attrs
 
         if 'scale' in attr:
-            layer = self.network.add_scale_nd(self.named_layer[source_node.in_edges[0]], mode=trt.ScaleMode(0), scale=np.array(attr['scale']).astype(np.float32), channel_axis=1)  
+            layer = self.network.add_scale_nd(input_, mode=trt.ScaleMode(0), scale=self._trt_weights(np.asarray(attr['scale'], dtype=np.float32)), channel_axis=1)
             layer.channel_axis = 3
         else:
-            layer = self.network.add_elementwise(self.named_layer[source_node.in_edges[0]], self.named_layer[source_node.in_edges[1]], trt.ElementWiseOperation.PROD)
+            layer = self.network.add_elementwise(input_, self.named_layer[source_node.in_edges[1]], trt.ElementWiseOperation.PROD)
 
         layer.name = source_node.name
-        caffe_layer = pb2.LayerParameter()
-        caffe_layer.name = source_node.name   
-        caffe_layer.type = 'Eltwise'      
-        caffe_layer.top.append(source_node.name)
-        caffe_layer.bottom.append(source_node.in_edges[0])
-        caffe_layer.bottom.append(source_node.in_edges[1])
-
-        self.main_layers.append(caffe_layer)
+        self._add_main(source_node.name, 'Eltwise', [source_node.name], source_node.in_edges[0:2])
         self.named_layer[source_node.name] = layer.get_output(0)
 
         return layer
@@ -518,36 +839,22 @@ class PytorchTensorRTParser(Parser):
         
         attr = source_node.attrs
 
-        if len(attr['pads']) == 4:
-            pads = (attr['pads'][0], attr['pads'][1])
-        elif len(attr['pads']) == 2:
-            pads = (attr['pads'][0], attr['pads'][1])
-
-        if 'strides' not in attr:
-            strides = None
-        else:
-            strides = (attr['strides'][0], attr['strides'][1])
-
-        if 'kernel_shape' not in attr:
-            kernel_shape = None
-        else:
-            kernel_shape = (attr['kernel_shape'][0], attr['kernel_shape'][1])
+        pre_padding, post_padding, strides, kernel_shape = _conv_attrs(attr)
 
         if source_node.weights_name == "":
             bias_name = 'bias'
             weights_name = 'weight'
         else:
-            bias_name = '{0}.bias'.format(source_node.weights_name)
-            weights_name = '{0}.weight'.format(source_node.weights_name)
+            bias_name = f"{source_node.weights_name}.bias"
+            weights_name = f"{source_node.weights_name}.weight"
 
-        weight = self.state_dict[weights_name]
-        weight = weight.numpy()
+        weight = self._weights_np[weights_name]
 
         num_output_maps = list(weight.shape)[1]
 
         # handle bias
-        if bias_name in self.state_dict:
-            bias = self.state_dict[bias_name].numpy()
+        if bias_name in self._weights_np:
+            bias = self._trt_weights(self._weights_np[bias_name])
         else:
             bias = trt.Weights()
 
@@ -562,24 +869,15 @@ class PytorchTensorRTParser(Parser):
             output_padding = attr['output_padding']  
 
         layer = self.network.add_deconvolution(input=self.named_layer[source_node.in_edges[0]], num_output_maps=num_output_maps,
-                                        kernel_shape=kernel_shape, kernel=weight, bias=bias)
+                                        kernel_shape=kernel_shape, kernel=self._trt_weights(weight), bias=bias)
         layer.stride = strides
         layer.num_groups = num_groups
 
-        if output_padding[0] + output_padding[1] > 0:
-            layer.pre_padding = pads
-            layer.post_padding = trt.tensorrt.DimsHW(pads[0] - output_padding[0], pads[1] - output_padding[1])
-        else:
-            layer.padding = pads   
+        layer.pre_padding = pre_padding
+        layer.post_padding = trt.tensorrt.DimsHW(post_padding[0] - output_padding[0], post_padding[1] - output_padding[1])
 
         layer.name = source_node.name
-        caffe_layer = pb2.LayerParameter()
-        caffe_layer.name = source_node.name    
-        caffe_layer.type = 'Deconvolution'
-        caffe_layer.top.append(source_node.name)
-        caffe_layer.bottom.append(source_node.in_edges[0])
-
-        self.main_layers.append(caffe_layer)
+        self._add_main(source_node.name, 'Deconvolution', [source_node.name], source_node.in_edges[0:1])
         self.named_layer[source_node.name] = layer.get_output(0)
 
         return layer
@@ -598,13 +896,7 @@ class PytorchTensorRTParser(Parser):
             layer.axis = attr['axis']
         layer.name = source_node.name
 
-        caffe_layer = pb2.LayerParameter()
-        caffe_layer.name = source_node.name   
-        caffe_layer.type = 'Concat'     
-        caffe_layer.top.append(source_node.name)
-        caffe_layer.bottom.extend(source_node.in_edges)
-
-        self.main_layers.append(caffe_layer)
+        self._add_main(source_node.name, 'Concat', [source_node.name], source_node.in_edges)
         self.named_layer[source_node.name] = layer.get_output(0)   
 
         return layer
@@ -623,21 +915,18 @@ class PytorchTensorRTParser(Parser):
         else:
             raise Exception('Shape get not be retrived')   
 
-        if isinstance(self.named_layer[source_node.in_edges[0]], trt.tensorrt.ITensor):
-            input_ = self.named_layer[source_node.in_edges[0]]
+        shuffle = self._shuffle_producer(source_node)
+        # a second reshape_dims replaces the first, unless a 0 refers back to the intermediate shape
+        if shuffle is not None and (shuffle[1] == 1 or (shuffle[1] == 2 and 0 not in shape)):
+            layer, _, perm = shuffle
+            layer.reshape_dims = shape
         else:
-            input_ = self.named_layer[source_node.in_edges[0]]
-
-        layer = self.network.add_shuffle(input_)
-        layer.reshape_dims = shape
-        layer.name = source_node.name
-        caffe_layer = pb2.LayerParameter()
-        caffe_layer.name = source_node.name    
-        caffe_layer.type = 'Reshape'    
-        caffe_layer.top.append(source_node.name)
-        caffe_layer.bottom.append(source_node.in_edges[0])
-
-        self.main_layers.append(caffe_layer)
+            layer = self.network.add_shuffle(self.named_layer[source_node.in_edges[0]])
+            layer.reshape_dims = shape
+            layer.name = source_node.name
+            perm = None
+        self._shuffle_layer[source_node.name] = (layer, 2, perm)
+        self._add_main(source_node.name, 'Reshape', [source_node.name], source_node.in_edges[0:1])
         self.named_layer[source_node.name] = layer.get_output(0)   
 
         return layer
@@ -653,16 +942,25 @@ class PytorchTensorRTParser(Parser):
         else:
             order = []
 
-        layer = self.network.add_shuffle(self.named_layer[source_node.in_edges[0]])
-        layer.first_transpose = order
-        layer.name = source_node.name
-        caffe_layer = pb2.LayerParameter()
-        caffe_layer.name = source_node.name 
-        caffe_layer.type = 'Permute'       
-        caffe_layer.top.append(source_node.name)
-        caffe_layer.bottom.append(source_node.in_edges[0])
-
-        self.main_layers.append(caffe_layer)
+        shuffle = self._shuffle_producer(source_node) if order else None
+        if shuffle is not None and (shuffle[1] == 2 or shuffle[2]):
+            layer, stage, perm = shuffle
+            if stage == 2:
+                stage, perm = 3, order
+            else:
+                perm = [perm[idx] for idx in order]
+            if stage == 1:
+                layer.first_transpose = perm
+            else:
+                layer.second_transpose = perm
+            self._shuffle_layer[source_node.name] = (layer, stage, perm)
+        else:
+            layer = self.network.add_shuffle(self.named_layer[source_node.in_edges[0]])
+            layer.first_transpose = order
+            layer.name = source_node.name
+            if order:
+                self._shuffle_layer[source_node.name] = (layer, 1, order)
+        self._add_main(source_node.name, 'Permute', [source_node.name], source_node.in_edges[0:1])
         self.named_layer[source_node.name] = layer.get_output(0)   
 
         return layer
@@ -670,15 +968,17 @@ class PytorchTensorRTParser(Parser):
     def rename_Resize(self, source_node):
         if not self.is_main(source_node.in_edges[0:1]):
             return None
+
+        input_ = self.named_layer[source_node.in_edges[0]]
         
         attr = source_node.attrs
 
-        layer = self.network.add_resize(self.named_layer[source_node.in_edges[0]])
+        layer = self.network.add_resize(input_)
         if 'scale_factor' in attr:
             scale = attr['scale_factor'][0]
             layer.scales = [1, 1, scale, scale]
         else:
-            input_shape = self.named_layer[source_node.in_edges[0]].shape
+            input_shape = input_.shape
             shape = list(input_shape[0:2]) + attr['output_size']
             layer.shape = shape
         
@@ -692,21 +992,15 @@ class PytorchTensorRTParser(Parser):
         elif attr['coordinate_transformation_mode'] == "asymmetric":
             layer.coordinate_transformation = trt.ResizeCoordinateTransformation.ASYMMETRIC       
         else:
-            raise
+            raise Exception('Unsupported coordinate_transformation_mode %s' % attr['coordinate_transformation_mode'])
 
         if attr['nearest_mode'] == 'floor':
             layer.nearest_rounding = trt.ResizeRoundMode.FLOOR 
         else:
-            raise
+            raise Exception('Unsupported nearest_mode %s' % attr['nearest_mode'])
 
         layer.name = source_node.name
-        caffe_layer = pb2.LayerParameter()
-        caffe_layer.name = source_node.name 
-        caffe_layer.type = 'Upsample'        
-        caffe_layer.top.append(source_node.name)
-        caffe_layer.bottom.append(source_node.in_edges[0])
-
-        self.main_layers.append(caffe_layer)
+        self._add_main(source_node.name, 'Upsample', [source_node.name], source_node.in_edges[0:1])
         self.named_layer[source_node.name] = layer.get_output(0)   
 
         return layer
@@ -730,13 +1024,7 @@ class PytorchTensorRTParser(Parser):
                 layer.padding_mode = trt.PaddingMode.EXPLICIT_ROUND_UP
        
         layer.name = source_node.name
-        caffe_layer = pb2.LayerParameter()
-        caffe_layer.name = source_node.name   
-        caffe_layer.type = 'GlobalPooling'       
-        caffe_layer.top.append(source_node.name)
-        caffe_layer.bottom.append(source_node.in_edges[0])
-
-        self.main_layers.append(caffe_layer)
+        self._add_main(source_node.name, 'GlobalPooling', [source_node.name], source_node.in_edges[0:1])
         self.named_layer[source_node.name] = layer.get_output(0)
 
         return layer
@@ -745,22 +1033,17 @@ class PytorchTensorRTParser(Parser):
         if not self.is_main(source_node.in_edges[0:1]):
             return None
  
+        network = self.network
         attr = source_node.attrs
         
         axis  = attr['axis']
         indices = attr['indices']
         # dims = trt.Dims(shape=[len(indices)])
 
-        const_layer = self.network.add_constant(shape=[len(indices)], weights=np.array(indices).astype(np.int32))
-        layer = self.network.add_gather(self.named_layer[source_node.in_edges[0]], indices=const_layer.get_output(0), axis=axis)
+        const_layer = network.add_constant(shape=[len(indices)], weights=self._trt_weights(np.asarray(indices, dtype=np.int32)))
+        layer = network.add_gather(self.named_layer[source_node.in_edges[0]], indices=const_layer.get_output(0), axis=axis)
         layer.name = source_node.name
-        caffe_layer = pb2.LayerParameter()
-        caffe_layer.name = source_node.name   
-        caffe_layer.type = 'Gather'       
-        caffe_layer.top.append(source_node.name)
-        caffe_layer.bottom.append(source_node.in_edges[0])
-
-        self.main_layers.append(caffe_layer)
+        self._add_main(source_node.name, 'Gather', [source_node.name], source_node.in_edges[0:1])
         self.named_layer[source_node.name] = layer.get_output(0)
 
         return layer
@@ -768,47 +1051,52 @@ class PytorchTensorRTParser(Parser):
     def rename_BatchNormalization(self, source_node):
         if not self.is_main(source_node.in_edges[0:1]):
             return None
+
+        if source_node.name in self._folded_bn:
+            self._alias(source_node, source_node.in_edges[0], 'BatchNorm')
+            return None
  
         if source_node.weights_name == "":
             mean_name = 'running_mean'
             var_name = 'running_var'
         else:
-            mean_name = '{0}.running_mean'.format(source_node.weights_name)
-            var_name = '{0}.running_var'.format(source_node.weights_name)
+            mean_name = f"{source_node.weights_name}.running_mean"
+            var_name = f"{source_node.weights_name}.running_var"
 
-        mean = self.state_dict[mean_name].numpy()
-        variance = self.state_dict[var_name].numpy()
+        mean = self._weights_np[mean_name]
+        variance = self._weights_np[var_name]
 
         if source_node.weights_name == "":
             bias_name = 'bias'
             weights_name = 'weight'
         else:
-            bias_name = '{0}.bias'.format(source_node.weights_name)
-            weights_name = '{0}.weight'.format(source_node.weights_name)
+            bias_name = f"{source_node.weights_name}.bias"
+            weights_name = f"{source_node.weights_name}.weight"
 
-        scale = self.state_dict[weights_name].numpy()
+        scale = self._weights_np[weights_name]
 
-        if bias_name in self.state_dict:
-            bias = self.state_dict[bias_name].numpy()
+        if bias_name in self._weights_np:
+            bias = self._weights_np[bias_name]
         else:
             bias = np.zeros_like(mean)
         
-        bn_eps = 1e-05
-        bn_var_rsqrt = 1 / np.sqrt(variance + bn_eps)
-
-        new_w = (scale * bn_var_rsqrt).reshape([-1] + [1] * (len(scale.shape) - 1))
-        new_b = (- mean) * bn_var_rsqrt * scale + bias
-
-        layer = self.network.add_scale(self.named_layer[source_node.in_edges[0]], mode=trt.ScaleMode(1), shift=new_b, scale=new_w)
+        bn_eps = np.float32(source_node.attrs.get('epsilon', 1e-05))
+
+        # new_w = scale / sqrt(var + eps), new_b = bias - mean * new_w
+        new_w = np.empty_like(scale)
+        np.add(variance, bn_eps, out=new_w)
+        np.sqrt(new_w, out=new_w)
+        np.reciprocal(new_w, out=new_w)
+        np.multiply(scale, new_w, out=new_w)
+        new_b = np.empty_like(mean)
+        np.multiply(new_w, mean, out=new_b)
+        np.subtract(bias, new_b, out=new_b)
+        new_w = new_w.reshape([-1] + [1] * (len(scale.shape) - 1))
+
+        layer = self.network.add_scale(self.named_layer[source_node.in_edges[0]], mode=trt.ScaleMode(1), shift=self._trt_weights(new_b), scale=self._trt_weights(new_w))
         layer.channel_axis = 1
         layer.name = source_node.name
-        caffe_layer = pb2.LayerParameter()
-        caffe_layer.name = source_node.name   
-        caffe_layer.type = 'BatchNorm'       
-        caffe_layer.top.append(source_node.name)
-        caffe_layer.bottom.append(source_node.in_edges[0])
-
-        self.main_layers.append(caffe_layer)
+        self._add_main(source_node.name, 'BatchNorm', [source_node.name], source_node.in_edges[0:1])
         self.named_layer[source_node.name] = layer.get_output(0)
 
         return layer     
@@ -822,13 +1110,7 @@ class PytorchTensorRTParser(Parser):
         layer = self.network.add_softmax(self.named_layer[source_node.in_edges[0]])
         layer.axes  = (1 << (attr['axis']))
         layer.name = source_node.name
-        caffe_layer = pb2.LayerParameter()
-        caffe_layer.name = source_node.name   
-        caffe_layer.type = 'Softmax'       
-        caffe_layer.top.append(source_node.name)
-        caffe_layer.bottom.append(source_node.in_edges[0])
- 
-        self.main_layers.append(caffe_layer)
+        self._add_main(source_node.name, 'Softmax', [source_node.name], source_node.in_edges[0:1])
         self.named_layer[source_node.name] = layer.get_output(0)
 
         return layer
@@ -839,18 +1121,18 @@ class PytorchTensorRTParser(Parser):
  
         attr = source_node.attrs
 
+        # TensorRT fuses conv + clip (relu6) on its own, but only when the conv output has no other consumer
+        producer = self.named_node.get(source_node.in_edges[0])
+        if producer is not None and producer.type == 'onnx::Conv' and len(producer.out_edges) > 1:
+            logger.debug("Clip [%s] follows branching Conv [%s], TensorRT will not fuse them."
+                  % (source_node.name, producer.name))
+
         layer = self.network.add_activation(self.named_layer[source_node.in_edges[0]], type=trt.ActivationType.CLIP)
         layer.alpha = attr['min']
         layer.beta = attr['max']
         layer.name = source_node.name
 
-        caffe_layer = pb2.LayerParameter()
-        caffe_layer.name = source_node.name   
-        caffe_layer.type = 'Relu6'       
-        caffe_layer.top.append(source_node.name)
-        caffe_layer.bottom.append(source_node.in_edges[0])
- 
-        self.main_layers.append(caffe_layer)
+        self._add_main(source_node.name, 'Relu6', [source_node.name], source_node.in_edges[0:1])
         self.named_layer[source_node.name] = layer.get_output(0)
 
         return layer
@@ -866,13 +1148,7 @@ class PytorchTensorRTParser(Parser):
         layer.beta = 0.5
         layer.name = source_node.name
 
-        caffe_layer = pb2.LayerParameter()
-        caffe_layer.name = source_node.name   
-        caffe_layer.type = 'HardSigmoid'       
-        caffe_layer.top.append(source_node.name)
-        caffe_layer.bottom.append(source_node.in_edges[0])
- 
-        self.main_layers.append(caffe_layer)
+        self._add_main(source_node.name, 'HardSigmoid', [source_node.name], source_node.in_edges[0:1])
         self.named_layer[source_node.name] = layer.get_output(0)
 
         return layer
@@ -880,23 +1156,19 @@ class PytorchTensorRTParser(Parser):
     def rename_HardSwish(self, source_node):
         if not self.is_main(source_node.in_edges[0:1]):
             return None
+
+        input_ = self.named_layer[source_node.in_edges[0]]
  
         attr = source_node.attrs
 
-        layer_hardsigmoid = self.network.add_activation(self.named_layer[source_node.in_edges[0]], type=trt.ActivationType.HARD_SIGMOID)
+        layer_hardsigmoid = self.network.add_activation(input_, type=trt.ActivationType.HARD_SIGMOID)
         layer_hardsigmoid.alpha = 0.5
         layer_hardsigmoid.beta = 0.5
 
-        layer = self.network.add_elementwise(self.named_layer[source_node.in_edges[0]], layer_hardsigmoid.get_output(0), trt.ElementWiseOperation.PROD)        
+        layer = self.network.add_elementwise(input_, layer_hardsigmoid.get_output(0), trt.ElementWiseOperation.PROD)        
         layer.name = source_node.name
 
-        caffe_layer = pb2.LayerParameter()
-        caffe_layer.name = source_node.name   
-        caffe_layer.type = 'HardSwish'       
-        caffe_layer.top.append(source_node.name)
-        caffe_layer.bottom.append(source_node.in_edges[0])
- 
-        self.main_layers.append(caffe_layer)
+        self._add_main(source_node.name, 'HardSwish', [source_node.name], source_node.in_edges[0:1])
         self.named_layer[source_node.name] = layer.get_output(0)
 
         return layer
@@ -914,18 +1186,10 @@ class PytorchTensorRTParser(Parser):
             pre_padding = (attr['pads'][2], attr['pads'][3]) # top left
             post_padding = (attr['pads'][6], attr['pads'][7]) # bottom right
 
-        attr = source_node.attrs
-
         layer = self.network.add_padding(self.named_layer[source_node.in_edges[0]], pre_padding, post_padding)        
         layer.name = source_node.name
 
-        caffe_layer = pb2.LayerParameter()
-        caffe_layer.name = source_node.name   
-        caffe_layer.type = 'Pad'       
-        caffe_layer.top.append(source_node.name)
-        caffe_layer.bottom.append(source_node.in_edges[0])
- 
-        self.main_layers.append(caffe_layer)
+        self._add_main(source_node.name, 'Pad', [source_node.name], source_node.in_edges[0:1])
         self.named_layer[source_node.name] = layer.get_output(0)
 
         return layer           
@@ -933,30 +1197,25 @@ class PytorchTensorRTParser(Parser):
     def rename_Split(self, source_node):
         if not self.is_main(source_node.in_edges[0:1]):
             return None
+
+        input_ = self.named_layer[source_node.in_edges[0]]
  
         attr = source_node.attrs
 
-        input_shape = self.named_layer[source_node.in_edges[0]].shape
+        input_shape = input_.shape
         start = [0, 0, 0, 0]
         for idx, output_id in enumerate(source_node.output_ids):
             shape = input_shape
             shape[attr['axis']] = attr['split'][idx]
             stride = [input_shape[0], 1, 1, 1]            
-            layer = self.network.add_slice(self.named_layer[source_node.in_edges[0]], start, shape, stride)        
+            layer = self.network.add_slice(input_, start, shape, stride)        
             output_name = source_node.name + ':' + output_id
             self.named_layer[output_name] = layer.get_output(0)
             layer.name = output_name
             start[attr['axis']] = start[attr['axis']] + attr['split'][idx]
 
-        caffe_layer = pb2.LayerParameter()
-        caffe_layer.name = source_node.name   
-        caffe_layer.type = 'Split'       
-        for output_id in source_node.output_ids:
-            output_id = source_node.name + ':' + output_id
-            caffe_layer.top.append(output_id)
-        caffe_layer.bottom.append(source_node.in_edges[0])
- 
-        self.main_layers.append(caffe_layer)
+        tops = [source_node.name + ':' + output_id for output_id in source_node.output_ids]
+        self._add_main(source_node.name, 'Split', tops, source_node.in_edges[0:1])
 
         return layer
 
@@ -972,13 +1231,7 @@ class PytorchTensorRTParser(Parser):
         layer = self.network.add_reduce(self.named_layer[source_node.in_edges[0]], op=trt.ReduceOperation.AVG, axes=axes, keep_dims=attr['keepdims'])
         layer.name = source_node.name
 
-        caffe_layer = pb2.LayerParameter()
-        caffe_layer.name = source_node.name   
-        caffe_layer.type = 'ReduceMean'       
-        caffe_layer.top.append(source_node.name)
-        caffe_layer.bottom.append(source_node.in_edges[0])
- 
-        self.main_layers.append(caffe_layer)
+        self._add_main(source_node.name, 'ReduceMean', [source_node.name], source_node.in_edges[0:1])
         self.named_layer[source_node.name] = layer.get_output(0)
 
         return layer
@@ -992,13 +1245,7 @@ class PytorchTensorRTParser(Parser):
         layer = self.network.add_activation(self.named_layer[source_node.in_edges[0]], type=trt.ActivationType.LEAKY_RELU)
         layer.alpha = attr['alpha']
         layer.name = source_node.name
-        caffe_layer = pb2.LayerParameter()
-        caffe_layer.name = source_node.name
-        caffe_layer.type = 'LeakyReLU'     
-        caffe_layer.top.append(source_node.name)
-        caffe_layer.bottom.append(source_node.in_edges[0])
-
-        self.main_layers.append(caffe_layer)
+        self._add_main(source_node.name, 'LeakyReLU', [source_node.name], source_node.in_edges[0:1])
         self.named_layer[source_node.name] = layer.get_output(0)   
 
         return layer
@@ -1006,15 +1253,17 @@ class PytorchTensorRTParser(Parser):
     def rename_Upsample(self, source_node):
         if not self.is_main(source_node.in_edges[0:1]):
             return None
+
+        input_ = self.named_layer[source_node.in_edges[0]]
         
         attr = source_node.attrs
 
-        layer = self.network.add_resize(self.named_layer[source_node.in_edges[0]])
+        layer = self.network.add_resize(input_)
         if 'scale_factor' in attr:
             scale = attr['scale_factor'][0]
             layer.scales = [1, 1, scale, scale]
         else:
-            input_shape = self.named_layer[source_node.in_edges[0]].shape
+            input_shape = input_.shape
             shape = list(input_shape[0:2]) + attr['output_size']
             layer.shape = shape
         
@@ -1028,21 +1277,15 @@ class PytorchTensorRTParser(Parser):
         elif attr['coordinate_transformation_mode'] == "asymmetric":
             layer.coordinate_transformation = trt.ResizeCoordinateTransformation.ASYMMETRIC       
         else:
-            raise
+            raise Exception('Unsupported coordinate_transformation_mode %s' % attr['coordinate_transformation_mode'])
 
         if attr['nearest_mode'] == 'floor':
             layer.nearest_rounding = trt.ResizeRoundMode.FLOOR 
         else:
-            raise
+            raise Exception('Unsupported nearest_mode %s' % attr['nearest_mode'])
 
         layer.name = source_node.name
-        caffe_layer = pb2.LayerParameter()
-        caffe_layer.name = source_node.name 
-        caffe_layer.type = 'Upsample'        
-        caffe_layer.top.append(source_node.name)
-        caffe_layer.bottom.append(source_node.in_edges[0])
-
-        self.main_layers.append(caffe_layer)
+        self._add_main(source_node.name, 'Upsample', [source_node.name], source_node.in_edges[0:1])
         self.named_layer[source_node.name] = layer.get_output(0)   
 
         return layer
@@ -1055,13 +1298,7 @@ class PytorchTensorRTParser(Parser):
         axes = 1 << (attr['axis'])
         layer = self.network.add_topk(self.named_layer[source_node.in_edges[0]], op=trt.TopKOperation.MAX, k=1, axes=axes)
         layer.name = source_node.name
-        caffe_layer = pb2.LayerParameter()
-        caffe_layer.name = source_node.name
-        caffe_layer.type = 'Argmax'     
-        caffe_layer.top.append(source_node.name)
-        caffe_layer.bottom.append(source_node.in_edges[0])
-
-        self.main_layers.append(caffe_layer)
+        self._add_main(source_node.name, 'Argmax', [source_node.name], source_node.in_edges[0:1])
         self.named_layer[source_node.name] = layer.get_output(1)   
 
         return layer
@@ -1069,15 +1306,17 @@ class PytorchTensorRTParser(Parser):
     def rename_BilinearInterpolate(self, source_node):
         if not self.is_main(source_node.in_edges[0:1]):
             return None
+
+        input_ = self.named_layer[source_node.in_edges[0]]
         
         attr = source_node.attrs
         logger.info(attr)
-        layer = self.network.add_resize(self.named_layer[source_node.in_edges[0]])
+        layer = self.network.add_resize(input_)
         if 'scale' in attr:
             scale = attr['scale'][0]
             layer.scales = [1, 1, scale, scale]
         else:
-            input_shape = self.named_layer[source_node.in_edges[0]].shape
+            input_shape = input_.shape
             shape = list(input_shape[0:2]) + attr['size']
             layer.shape = shape
         
@@ -1090,13 +1329,7 @@ class PytorchTensorRTParser(Parser):
             layer.coordinate_transformation = trt.ResizeCoordinateTransformation.ALIGN_CORNERS
 
         layer.name = source_node.name
-        caffe_layer = pb2.LayerParameter()
-        caffe_layer.name = source_node.name 
-        caffe_layer.type = 'BilinearInterpolate'        
-        caffe_layer.top.append(source_node.name)
-        caffe_layer.bottom.append(source_node.in_edges[0])
-
-        self.main_layers.append(caffe_layer)
+        self._add_main(source_node.name, 'BilinearInterpolate', [source_node.name], source_node.in_edges[0:1])
         self.named_layer[source_node.name] = layer.get_output(0)   
 
         return layer        
\ No newline at end of file
@@ -10,6 +10,29 @@ def test_BatchNorm2d(shape = [1, 3, 32, 32], opset_version=13):
     model = torch.nn.BatchNorm2d(3)
     Tester("BatchNorm2d", model, shape, opset_version)
 
+def test_BatchNorm2d_eps(shape = [1, 3, 32, 32], opset_version=13):
+    model = torch.nn.BatchNorm2d(3, eps=1e-3)
+    Tester("BatchNorm2d_eps", model, shape, opset_version)
+
+class FunctionalBatchNorm2d(torch.nn.Module):
+    def __init__(self, num_features, eps=1e-05):
+        super(FunctionalBatchNorm2d, self).__init__()
+        self.eps = eps
+        self.weight = torch.nn.Parameter(torch.rand(num_features))
+        self.bias = torch.nn.Parameter(torch.rand(num_features))
+        self.register_buffer('running_mean', torch.rand(num_features))
+        self.register_buffer('running_var', torch.rand(num_features) + 0.5)
+
+    def forward(self, x):
+        # the input check also keeps torch.fx from tracing, so the conv/bn pair is left to fold_conv_bn
+        if x.dim() != 4:
+            raise ValueError("expected 4D input (got {}D input)".format(x.dim()))
+        return torch.nn.functional.batch_norm(x, self.running_mean, self.running_var, self.weight, self.bias, False, 0.1, self.eps)
+
+def test_Conv2d_FunctionalBatchNorm2d(shape = [1, 3, 32, 32], opset_version=13):
+    model = torch.nn.Sequential(torch.nn.Conv2d(3, 8, 3), FunctionalBatchNorm2d(8, eps=1e-3))
+    Tester("Conv2d_FunctionalBatchNorm2d", model, shape, opset_version)
+
 
 if __name__ == '__main__':
     warnings.filterwarnings('ignore')
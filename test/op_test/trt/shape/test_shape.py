@@ -188,6 +188,26 @@ def test_View_4d(shape = ([1, 3, 3, 3]), opset_version=9):
     model = View(1, 3, 3, -1)
     Tester("View_4d", model, shape, opset_version)
 
+def test_Permute_View(shape = [1, 3, 8, 16], opset_version=13):
+    model = torch.nn.Sequential(Permute(0, 2, 3, 1), View(1, -1, 3))
+    Tester("Permute_View", model, shape, opset_version)
+
+def test_View_Permute(shape = [1, 3, 8, 16], opset_version=13):
+    model = torch.nn.Sequential(View(1, 6, 4, 16), Permute(0, 3, 1, 2))
+    Tester("View_Permute", model, shape, opset_version)
+
+def test_Permute_Permute(shape = [1, 3, 8, 16], opset_version=13):
+    model = torch.nn.Sequential(Permute(0, 2, 3, 1), Permute(0, 2, 1, 3))
+    Tester("Permute_Permute", model, shape, opset_version)
+
+def test_View_Permute_Permute(shape = [1, 3, 8, 16], opset_version=13):
+    model = torch.nn.Sequential(View(1, 6, 4, 16), Permute(0, 3, 1, 2), Permute(0, 1, 3, 2))
+    Tester("View_Permute_Permute", model, shape, opset_version)
+
+def test_View_View(shape = [1, 3, 8, 16], opset_version=13):
+    model = torch.nn.Sequential(View(1, 3, -1), View(1, 24, 16))
+    Tester("View_View", model, shape, opset_version)
+
 
 if __name__ == '__main__':
     warnings.filterwarnings('ignore')
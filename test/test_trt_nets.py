@@ -29,6 +29,24 @@ def test_resnet18(shape = [1, 3, 224, 224], opset_version=9):
     runner.trt_inference()
     runner.check_result()
 
+def test_resnet18_graph(shape = [1, 3, 224, 224], opset_version=9):
+    net = models.resnet18(pretrained=False)
+    runner = Runner("resnet18_graph", net, shape, opset_version)
+    runner.pyotrch_inference()
+    runner.convert()
+    runner.graph_inference()
+    runner.check_result()
+
+def test_resnet18_onnx_parser(shape = [1, 3, 224, 224], opset_version=9):
+    net = models.resnet18(pretrained=False)
+    runner = Runner("resnet18_onnx_parser", net, shape, opset_version, use_onnx_parser=True)
+    runner.pyotrch_inference()
+    runner.convert()
+    # parse_onnx falls back to the implicit batch rename_* path on failure
+    assert not runner.pytorch_parser.engine.has_implicit_batch_dimension
+    runner.trt_inference()
+    runner.check_result()
+
 def test_squeezenet(shape = [1, 3, 227, 227], opset_version=9):
     net = models.squeezenet1_0(pretrained=False)
     runner = Runner("squeezenet", net, shape, opset_version)